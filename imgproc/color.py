@@ -1,5 +1,5 @@
 from imgproc.random import sample_from_array
-from imgproc.utils import check_img_arg, hex_to_rgb, hilo, pwd
+from imgproc.utils import check_img_arg, hex_to_rgb, hilo, map_unique_colors, pwd
 import json
 import numpy as np
 import os
@@ -7,6 +7,10 @@ import os
 DEF_BLACK_FILE = 'colors_black.json'
 DEF_COLOR_FILE = 'colors.json'
 DEF_WHITE_FILE = 'colors_white.json'
+D65_WHITE = np.array([0.95047, 1., 1.08883], dtype=np.float32)
+RGB_TO_XYZ = np.array([[0.4124, 0.3576, 0.1805],
+					   [0.2126, 0.7152, 0.0722],
+					   [0.0193, 0.1192, 0.9505]], dtype=np.float32)
 
 
 def complementary_color(rgb):
@@ -19,10 +23,22 @@ def negative_color(rgb):
 
 
 def complement(img):
-	check_img_arg(img)
-	h, w = img.shape[:2]
-	img_mod = np.array([complementary_color(img[i, j]) for i in range(h) for j in range(w)])
-	return img_mod.reshape(img.shape)
+	check_img_arg(img, allow_batch=True)
+	return map_unique_colors(img, complementary_color)
+
+
+# sRGB (D65) to CIELAB, as float32 with L in [0, 100]
+# see https://en.wikipedia.org/wiki/CIELAB_color_space
+def rgb_to_lab(img):
+	rgb = img.astype(np.float32) / 255.
+	rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+	xyz = np.dot(rgb, RGB_TO_XYZ.T) / D65_WHITE
+	f = np.where(xyz > (6. / 29.) ** 3, np.cbrt(xyz), xyz / (3. * (6. / 29.) ** 2) + 4. / 29.)
+	lab = np.empty_like(f)
+	lab[..., 0] = 116. * f[..., 1] - 16.
+	lab[..., 1] = 500. * (f[..., 0] - f[..., 1])
+	lab[..., 2] = 200. * (f[..., 1] - f[..., 2])
+	return lab
 
 
 def fetch_color(name, color_file=DEF_COLOR_FILE):
@@ -1,7 +1,7 @@
 from collections import defaultdict
 from imgproc.io import list_files, load_folder_imgs, load_rgb, open_yaml_as_dict
 from imgproc.render import grid, show
-from imgproc.scan import glob_entropy, glob_luminance, num_colors, dist_to_color, dist_to_mode
+from imgproc.scan import ColorIndex, glob_entropy, glob_luminance, num_colors, dist_to_color, dist_to_mode
 from imgproc.utils import identify_filesize
 import numpy as np
 import os
@@ -79,24 +79,31 @@ def rank_grid(dirpath, func, desc, k):
 	grid(imgs, warn=False)
 
 
-def rank_grid_preload(imgs, imgfiles, func, desc, k):
-	ranked_imgfiles, scores, rank_idxs = rank_imgs(imgs, imgfiles, func, k, return_scores=True)
+# func is given the items of scored (e.g. color indexes of the images) in place of the images if given
+def rank_grid_preload(imgs, imgfiles, func, desc, k, scored=None):
+	scored = imgs if scored is None else scored
+	ranked_imgfiles, scores, rank_idxs = rank_imgs(scored, imgfiles, func, k, return_scores=True)
 	print('{} :'.format(desc))
 	for rank, (imgfile, score) in enumerate(zip(ranked_imgfiles, scores)):
 		print('{}: {} -- score : {}'.format(rank + 1, imgfile, np.abs(score)))
 	grid([imgs[ind] for ind in rank_idxs], warn=False)
 
 
-def leaderboard(dirpath, funcs=DEF_FUNCS, descs=DEF_DESCS, k=DEF_RANKED, preload=False):
+# with preload, funcs get a ColorIndex of each image (built once for all of them) unless color_index is False
+# this is the default for DEF_FUNCS, whose scan metrics all read from it
+def leaderboard(dirpath, funcs=DEF_FUNCS, descs=DEF_DESCS, k=DEF_RANKED, preload=False, color_index=None):
+	if color_index is None:
+		color_index = funcs is DEF_FUNCS
 	if preload:
 		imgs, imgfiles = load_folder_imgs(dirpath)
+		scored = [ColorIndex(img) for img in imgs] if color_index else None
 	exp_name = os.path.basename(dirpath)
 	print('-' * (35 + len(exp_name)))
 	print('|   Leaderboard for experiment {}   |'.format(exp_name))
 	print('-' * (35 + len(exp_name)) + '\n')
 	for func, desc in zip(funcs, descs):
 		if preload:
-			rank_grid_preload(imgs, imgfiles, func, desc, k)
+			rank_grid_preload(imgs, imgfiles, func, desc, k, scored)
 		else:
 			rank_grid(dirpath, func, desc, k)
 
@@ -1,5 +1,5 @@
 from copy import deepcopy
-from imgproc.utils import make_canvas
+from imgproc.utils import make_canvas, make_output
 import numpy as np
 
 
@@ -11,10 +11,12 @@ def add_white_frame(img, frame_height, frame_width):
 	return framed_img
 
 
-def width_border(img, frame_width):
+def width_border(img, frame_width, out=None):
 	fw = frame_width // 2
 	size = img.shape[:2]
-	framed_img = deepcopy(img)
+	framed_img = make_output(img, out)
+	if framed_img is not img:
+		framed_img[:] = img
 	framed_img[:, 0: fw] = np.array([255, 255, 255])
 	framed_img[:, size[1] - fw:] = np.array([255, 255, 255])
 	return framed_img
@@ -1,5 +1,5 @@
 import imageio
-from imgproc.utils import (check_img_arg, check_imgfile_arg, is_img_file, identify_format,
+from imgproc.utils import (check_img_arg, check_imgfile_arg, is_img_file, is_rgb_batch, identify_format,
 						   identify_dimensions, identify_filesize, pil_to_numpy)
 import math
 import matplotlib
@@ -138,10 +138,12 @@ def open_yaml_as_dict(filepath):
 
 
 # https://stackoverflow.com/questions/753190/programmatically-generate-video-or-animated-gif-in-python
+# imgs is either a list of images or a (N, H, W, 3) stack
 def save_as_gif(imgs, savefile, use_default=False):
-	if not isinstance(imgs, list):
-		raise TypeError('Expecting a list as first argument.')
-	check_img_arg(imgs[0], allow_grayscale=True)
+	if isinstance(imgs, list):
+		check_img_arg(imgs[0], allow_grayscale=True)
+	elif not is_rgb_batch(imgs):
+		raise TypeError('Expecting a list or a (N, H, W, 3) array as first argument.')
 	if use_default:
 		savefile = os.path.join(DEFAULT_DIR, savefile)
 	else:
@@ -1,217 +1,812 @@
+from collections import OrderedDict
 from copy import deepcopy
+from imgproc.palette import extract_palette
 from imgproc.scan import background_color
-from imgproc.utils import numpy_to_pil, pil_to_numpy, num_hash
+from imgproc.tone import ToneCurve
+from imgproc.utils import (check_colors, img_to_hue, img_to_luminance, is_iterable, make_output,
+						   map_unique_colors, num_hash)
+import math
 import numpy as np
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
-from scipy.ndimage import interpolation
-
-
-def modify_vividness(img, factor):
-	modifier = ImageEnhance.Color(numpy_to_pil(img))
-	img_mod = modifier.enhance(factor)
-	return pil_to_numpy(img_mod)
-
-
-def modify_brightness(img, factor):
-	modifier = ImageEnhance.Brightness(numpy_to_pil(img))
-	img_mod = modifier.enhance(factor)
-	return pil_to_numpy(img_mod)
+from scipy.ndimage import correlate1d
+from scipy.spatial import cKDTree
+
+DEF_BOX_BLUR_RADIUS = 24
+PYRAMID_BOX_RADIUS = 8
+DEF_PYRAMID_MIN_RADIUS = 4.
+DEF_PYRAMID_MIN_SIZE = 8
+PYRAMID_MARGIN = 4
+DEF_PIXELSORT_BATCH = 0.1
+PIXELSORT_TREE_K = 8
+DEF_WARP_CACHE_BYTES = 2 ** 28
+
+_WARP_CACHE = OrderedDict()
+
+
+# PIL's ITU-R 601-2 luma transform, in fixed point
+# grayscale (H, W) images are their own luma, as PIL's 'L' mode
+# see https://pillow.readthedocs.io/en/stable/reference/Image.html#PIL.Image.Image.convert
+def _luma(img):
+	if img.ndim == 2:
+		return img
+	lum = np.multiply(img[..., 0], 19595, dtype=np.uint32)
+	lum += np.multiply(img[..., 1], 38470, dtype=np.uint32)
+	lum += np.multiply(img[..., 2], 7471, dtype=np.uint32)
+	lum += 0x8000
+	lum >>= 16
+	return lum.astype(np.uint8)
+
+
+# PIL's ImageEnhance blending : degenerate + factor * (img - degenerate), in float32
+# clipped then truncated to uint8
+def _blend(img, degenerate, factor, out):
+	out = make_output(img, out)
+	temp = img.astype(np.float32)
+	temp -= degenerate
+	temp *= np.float32(factor)
+	temp += degenerate
+	np.clip(temp, 0, 255, out=temp)
+	np.copyto(out, temp, casting='unsafe')
+	return out
+
+
+# PIL approximates a gaussian blur with three passes of an extended box blur along each axis
+# see http://www.mia.uni-saarland.de/Publications/gwosdek-ssvm11.pdf
+# returns the half width l of the box and the weight a of its two extra end taps
+def _box_params(radius, passes=3):
+	sigma2 = radius ** 2 / passes
+	l = math.floor((math.sqrt(12. * sigma2 + 1.) - 1.) / 2.)
+	a = (2 * l + 1) * (l * (l + 1) - 3 * sigma2) / (6 * (sigma2 - (l + 1) ** 2))
+	return l, a
+
+
+def _blur_box(radius, passes=3):
+	l, a = _box_params(radius, passes)
+	box = np.ones(2 * l + 3, dtype=np.float32)
+	box[0] = box[-1] = a
+	box /= 2 * (l + a) + 1
+	return box
+
+
+# slice from start to stop along axis
+def _along(axis, start, stop, ndim):
+	idx = [slice(None)] * ndim
+	idx[axis] = slice(start, stop)
+	return tuple(idx)
+
+
+# PIL's fixed point weights of the extended box : half width, weight of the 2 * l + 1 inner taps and
+# of the two end taps, out of 2 ** 24, computed in single precision as PIL does
+# see https://github.com/python-pillow/Pillow/blob/main/src/libImaging/BoxBlur.c
+def _fixed_box(radius, passes=3):
+	f32 = np.float32
+	sigma2 = f32(radius) * f32(radius) / f32(passes)
+	l = f32(math.floor((float(f32(math.sqrt(12. * sigma2 + 1.))) - 1.) / 2.))
+	a = (f32(2) * l + f32(1)) * (l * (l + f32(1)) - f32(3) * sigma2)
+	a /= f32(6) * (sigma2 - (l + f32(1)) * (l + f32(1)))
+	box_radius = l + a
+	l = int(box_radius)
+	inner = int(f32(2 ** 24) / (box_radius * f32(2) + f32(1)))
+	return l, inner, (2 ** 24 - (2 * l + 1) * inner) // 2
+
+
+# one extended box pass along axis from cumulative sums, whatever the box width
+# the 2 * l + 1 inner taps weigh `inner`, the two end ones `end`
+# edges are replicated, as correlate1d(mode='nearest')
+def _box_pass(img_mod, l, inner, end, axis):
+	n = img_mod.shape[axis]
+	pad = [(0, 0)] * img_mod.ndim
+	pad[axis] = (l + 1, l + 1)
+	padded = np.pad(img_mod, pad, mode='edge')
+	shape = list(padded.shape)
+	shape[axis] += 1
+	cumul = np.zeros(shape, dtype=img_mod.dtype)
+	np.cumsum(padded, axis=axis, out=cumul[_along(axis, 1, None, cumul.ndim)])
+	res = cumul[_along(axis, 2 * l + 2, 2 * l + 2 + n, cumul.ndim)] - cumul[_along(axis, 1, 1 + n, cumul.ndim)]
+	res *= inner
+	ends = padded[_along(axis, 0, n, padded.ndim)] + padded[_along(axis, 2 * l + 2, 2 * l + 2 + n, padded.ndim)]
+	ends *= end
+	res += ends
+	return res
+
+
+def modify_vividness(img, factor, out=None):
+	degenerate = _luma(img).astype(np.float32)
+	if img.ndim > 2:
+		degenerate = degenerate[..., np.newaxis]
+	return _blend(img, degenerate, factor, out)
+
+
+def modify_brightness(img, factor, out=None):
+	return ToneCurve().brightness(factor).apply(img, out)
+
+
+# frames of an (N, H, W, 3) stack are each adjusted from their own mean (or histograms with optimize),
+# as when called frame by frame, unless `shared`, where one curve fit on the whole stack is applied to all
+def modify_contrast(img, factor, optimize=False, out=None, shared=False):
+	if img.ndim == 4 and not shared:
+		out = make_output(img, out)
+		for frame, frame_out in zip(img, out):
+			modify_contrast(frame, factor, optimize, out=frame_out)
+		return out
+	if optimize:
+		return ToneCurve().autocontrast(img).apply(img, out)
+	return ToneCurve().contrast(factor, mean=np.mean(_luma(img))).apply(img, out)
 
 
-def modify_contrast(img, factor, optimize=False):
-	if optimize:
-		img_mod = ImageOps.autocontrast(numpy_to_pil(img))
-	else:
-		modifier = ImageEnhance.Contrast(numpy_to_pil(img))
-		img_mod = modifier.enhance(factor)
-	return pil_to_numpy(img_mod)
+def to_grayscale(img, out=None):
+	out = make_output(img, out)
+	out[:] = _luma(img) if img.ndim == 2 else _luma(img)[..., np.newaxis]
+	return out
 
 
-def to_grayscale(img):
-	img_mod = ImageOps.grayscale(numpy_to_pil(img))
-	return pil_to_numpy(img_mod, from_grayscale=True)
+def to_negative(img, out=None):
+	return np.subtract(255, img, out=make_output(img, out), dtype=np.uint8)
 
 
-def to_negative(img):
-	img_mod = ImageOps.invert(numpy_to_pil(img))
-	return pil_to_numpy(img_mod)
+# returns a view of img unless `out` is given
+# img can be grayscale (H, W), rgb (H, W, 3) or a stack (N, H, W, 3)
+def flip(img, side='ud', out=None):
+	if side not in ('ud', 'rl'):
+		err = "Side argument takes either 'ud' or 'rl' as a value"
+		raise ValueError(err)
+	row_axis = 0 if img.ndim == 2 else img.ndim - 3
+	img_mod = np.flip(img, row_axis if side == 'ud' else row_axis + 1)
+	if out is None:
+		return img_mod
+	out = make_output(img, out)
+	out[:] = img_mod
+	return out
+
+
+# float32 gaussian blur without rounding between passes, for the levels of BlurPyramid
+# in place when the boxes are narrow enough to be correlated directly, through cumulative sums otherwise
+def _blur_float(img_mod, radius):
+	if radius <= 0:
+		return img_mod
+	if radius <= PYRAMID_BOX_RADIUS:
+		box = _blur_box(radius)
+		for axis in (-2, -3):
+			for _ in range(3):
+				correlate1d(img_mod, box, axis=axis, mode='nearest', output=img_mod)
+		return img_mod
+	return _box_blur_float(img_mod, radius)
+
+
+def _box_blur_float(img_mod, radius):
+	l, a = _box_params(radius)
+	norm = 2 * (l + a) + 1
+	for axis in (-2, -3):
+		for _ in range(3):
+			img_mod = _box_pass(img_mod, l, np.float32(1. / norm), np.float32(a / norm), axis)
+	return img_mod
 
 
-def flip(img, side='ud'):
+def _to_uint8(img_mod, out):
+	img_mod += 0.5
+	np.copyto(out, img_mod, casting='unsafe')
+	return out
+
+
+# PIL's gaussian blur : each box pass is computed in fixed point and rounded to uint8 as PIL does,
+# so that results are those of ImageFilter.GaussianBlur
+# values stay integers below 2 ** 33 along a pass, float64 holds them exactly
+# narrow boxes are correlated directly, wider ones go through cumulative sums (constant time per pixel)
+# rows are blurred first then columns, on the last two axes of (H, W) grayscale images
+def _fixed_blur(img, radius, out, cumulative):
+	out = make_output(img, out)
+	if radius <= 0:
+		out[:] = img
+		return out
+	l, inner, end = _fixed_box(radius)
+	box = np.full(2 * l + 3, inner, dtype=np.float64)
+	box[0] = box[-1] = end
+	img_mod = img.astype(np.float64)
+	for axis in ((-1, -2) if img.ndim == 2 else (-2, -3)):
+		for _ in range(3):
+			if cumulative:
+				img_mod = _box_pass(img_mod, l, inner, end, axis)
+			else:
+				correlate1d(img_mod, box, axis=axis, mode='nearest', output=img_mod)
+			img_mod += 2 ** 23
+			img_mod *= 2. ** -24
+			np.floor(img_mod, out=img_mod)
+	np.copyto(out, img_mod, casting='unsafe')
+	return out
+
+
+def blur(img, radius=2., out=None):
+	return _fixed_blur(img, radius, out, radius > DEF_BOX_BLUR_RADIUS)
+
+
+# same blur as blur(), always computed from cumulative sums
+def box_blur(img, radius=2., out=None):
+	return _fixed_blur(img, radius, out, True)
+
+
+# replicates the edges of an image (or stack) over margin pixels on each side
+def _pad_edges(img_mod, margin, odd=False):
+	h, w = img_mod.shape[-3:-1]
+	pad = [(0, 0)] * img_mod.ndim
+	pad[-3], pad[-2] = (margin, margin + odd * (h % 2)), (margin, margin + odd * (w % 2))
+	return np.pad(img_mod, pad, mode='edge')
+
+
+# 2 x 2 block means of an image (or stack), edges replicated when a side is odd
+def _halve(img_mod):
+	img_mod = _pad_edges(img_mod, 0, odd=True)
+	h, w = img_mod.shape[-3:-1]
+	blocks = img_mod.reshape(img_mod.shape[:-3] + (h // 2, 2, w // 2, 2, img_mod.shape[-1]))
+	return blocks.mean(axis=(-4, -2), dtype=np.float32)
+
+
+# bilinear upsampling along axis of a level downsampled by scale, to n samples
+# origin is the coordinate, in samples, of the level's first pixel edge
+def _upsample(img_mod, scale, origin, n, axis):
+	coords = (np.arange(n, dtype=np.float32) + 0.5 - origin) / scale - 0.5
+	np.clip(coords, 0, img_mod.shape[axis] - 1, out=coords)
+	lo = coords.astype(np.intp)
+	hi = np.minimum(lo + 1, img_mod.shape[axis] - 1)
+	shape = [1] * img_mod.ndim
+	shape[axis] = n
+	w = (coords - lo).reshape(shape)
+	res = np.take(img_mod, lo, axis=axis)
+	res += w * (np.take(img_mod, hi, axis=axis) - res)
+	return res
+
+
+# blurs of one source image at many radii, e.g. when sweeping a radius parameter
+# level k is the source blurred and downsampled k times by 2, built once and shared by all radii
+# blurring with r1 then r2 is a blur with sqrt(r1 ** 2 + r2 ** 2) : a radius is reached from the coarsest
+# level whose own blur is narrow enough, with the remaining blur done at that level's resolution before
+# upsampling back, so that wide blurs cost a fraction of a full resolution blur
+# at least `min_radius` pixels of blur are left at the chosen level, which keeps the bilinear upsampling
+# from showing : results are close to blur(img, radius), not bit-identical
+# each level extends past the image by replicated edges : borders are those of a blur of the image padded
+# once, which on wide radii differs a bit from blur() replicating the edges at each box pass
+class BlurPyramid:
+
+	def __init__(self, img, min_radius=DEF_PYRAMID_MIN_RADIUS, min_size=DEF_PYRAMID_MIN_SIZE):
+		if min_radius <= 0:
+			raise ValueError('min_radius must be positive.')
+		self.img = img
+		self.min_radius = min_radius
+		self.min_size = min_size
+		# (level, variance of its blur in source pixels, source coordinate of its first pixel edge)
+		self.levels = []
+
+	def __len__(self):
+		return len(self.levels)
+
+	def __call__(self, radius, out=None):
+		return self.blur(radius, out)
+
+	def _level(self, k):
+		if not self.levels:
+			self.levels.append((self.img.astype(np.float32), 0., 0.))
+		while len(self.levels) <= k:
+			level, var, origin = self.levels[-1]
+			scale = 2 ** (len(self.levels) - 1)
+			# anti-aliasing blur of 1 pixel, then the 2 pixels wide box of the block means
+			level = _halve(_blur_float(_pad_edges(level, PYRAMID_MARGIN), 1.))
+			self.levels.append((level, var + scale ** 2 * 1.25, origin - PYRAMID_MARGIN * scale))
+		return self.levels[k]
+
+	# coarsest level leaving at least min_radius pixels of blur to do at its resolution
+	def _pick(self, radius):
+		h, w = self.img.shape[-3:-1]
+		k, var = 0, 0.
+		while min(h, w) // 2 ** (k + 1) >= self.min_size:
+			var += 4 ** k * 1.25
+			if radius ** 2 - var < (self.min_radius * 2 ** (k + 1)) ** 2:
+				break
+			k += 1
+		return k
+
+	def blur(self, radius, out=None):
+		out = make_output(self.img, out)
+		if radius <= 0:
+			out[:] = self.img
+			return out
+		k = self._pick(radius)
+		level, var, origin = self._level(k)
+		scale = 2 ** k
+		img_mod = _blur_float(level.copy(), math.sqrt(radius ** 2 - var) / scale)
+		if k:
+			h, w = self.img.shape[-3:-1]
+			img_mod = _upsample(_upsample(img_mod, scale, origin, h, -3), scale, origin, w, -2)
+		return _to_uint8(img_mod, out)
+
+
+# forward affine matrices (3 x 3) on (row, col) coordinates, composed with `@`
+# e.g. translation_matrix(0, 10) @ rotation_matrix(30, center) rotates, then shifts right by 10 pixels
+def translation_matrix(xmod, ymod):
+	return np.array([[1., 0., xmod], [0., 1., ymod], [0., 0., 1.]])
+
+
+def _about(matrix, center):
+	return translation_matrix(*center) @ matrix @ translation_matrix(-center[0], -center[1])
+
+
+# counter-clockwise rotation of dg degrees around center
+def rotation_matrix(dg, center=(0., 0.)):
+	c, s = math.cos(math.radians(dg)), math.sin(math.radians(dg))
+	return _about(np.array([[c, -s, 0.], [s, c, 0.], [0., 0., 1.]]), center)
+
+
+def scaling_matrix(factor, center=(0., 0.)):
+	fx, fy = factor if is_iterable(factor) else (factor, factor)
+	return _about(np.array([[fx, 0., 0.], [0., fy, 0.], [0., 0., 1.]]), center)
+
+
+def flip_matrix(shape, side='ud'):
+	h, w = shape[:2]
 	if side == 'ud':
-		return img[::-1]
+		return np.array([[-1., 0., h - 1.], [0., 1., 0.], [0., 0., 1.]])
 	elif side == 'rl':
-		return img[:, ::-1]
+		return np.array([[1., 0., 0.], [0., -1., w - 1.], [0., 0., 1.]])
 	else:
 		err = "Side argument takes either 'ud' or 'rl' as a value"
 		raise ValueError(err)
 
 
-def blur(img, radius=2.):
-	f = ImageFilter.GaussianBlur(radius)
-	img_mod = numpy_to_pil(img).filter(f)
-	return pil_to_numpy(img_mod)
+# brings (integer) coordinates back into [0, n - 1] following the boundary mode
+# pixels falling outside are flagged for constant fills
+def _remap(idx, n, boundary):
+	if boundary == 'wrap':
+		return idx % n, None
+	elif boundary == 'reflect':
+		idx = idx % (2 * n)
+		return np.where(idx >= n, 2 * n - 1 - idx, idx), None
+	elif boundary == 'mirror':
+		if n == 1:
+			return np.zeros_like(idx), None
+		idx = idx % (2 * n - 2)
+		return np.where(idx >= n, 2 * n - 2 - idx, idx), None
+	outside = (idx < 0) | (idx >= n) if boundary == 'constant' else None
+	return np.clip(idx, 0, n - 1), outside
+
+
+# source pixels (flat indices), bilinear weights and outside mask of each output pixel
+def _warp_map(in_shape, out_shape, matrix, order, boundary):
+	key = (in_shape, out_shape, matrix.tobytes(), order, boundary)
+	if key in _WARP_CACHE:
+		_WARP_CACHE.move_to_end(key)
+		return _WARP_CACHE[key]
+	(h, w), (oh, ow) = in_shape, out_shape
+	inv = np.linalg.inv(matrix)
+	rows, cols = np.arange(oh)[:, np.newaxis], np.arange(ow)[np.newaxis, :]
+	src_rows = np.ravel(inv[0, 0] * rows + inv[0, 1] * cols + inv[0, 2])
+	src_cols = np.ravel(inv[1, 0] * rows + inv[1, 1] * cols + inv[1, 2])
+	if order == 'nearest':
+		(ri, out_r), (ci, out_c) = _remap(np.floor(src_rows + 0.5).astype(np.int64), h, boundary), \
+								   _remap(np.floor(src_cols + 0.5).astype(np.int64), w, boundary)
+		indices, weights = (ri * w + ci).astype(np.int32)[np.newaxis], None
+	elif order == 'bilinear':
+		r0, c0 = np.floor(src_rows), np.floor(src_cols)
+		fr, fc = (src_rows - r0).astype(np.float32), (src_cols - c0).astype(np.float32)
+		r0, c0 = r0.astype(np.int64), c0.astype(np.int64)
+		(ri, _), (ri1, _) = _remap(r0, h, boundary), _remap(r0 + 1, h, boundary)
+		(ci, _), (ci1, _) = _remap(c0, w, boundary), _remap(c0 + 1, w, boundary)
+		indices = np.stack([ri * w + ci, ri * w + ci1, ri1 * w + ci, ri1 * w + ci1]).astype(np.int32)
+		weights = np.stack([(1 - fr) * (1 - fc), (1 - fr) * fc, fr * (1 - fc), fr * fc])
+		# pixels sampled from outside [0, n - 1] on either axis are filled
+		out_r = (src_rows < 0) | (src_rows > h - 1) if boundary == 'constant' else None
+		out_c = (src_cols < 0) | (src_cols > w - 1) if boundary == 'constant' else None
+	else:
+		raise ValueError("`order` expected values are 'nearest' or 'bilinear'.")
+	outside = None if out_r is None else np.flatnonzero(out_r | out_c)
+	_cache_warp_map(key, (indices, weights, outside))
+	return indices, weights, outside
+
+
+def _map_nbytes(warp_map):
+	return sum(arr.nbytes for arr in warp_map if arr is not None)
+
+
+# maps are bounded by their total size (about 32 bytes per output pixel for bilinear ones),
+# the least recently used are dropped first and maps larger than the whole budget are not kept
+def _cache_warp_map(key, warp_map):
+	nbytes = _map_nbytes(warp_map)
+	if nbytes > DEF_WARP_CACHE_BYTES:
+		return
+	_WARP_CACHE[key] = warp_map
+	total = sum(_map_nbytes(cached) for cached in _WARP_CACHE.values())
+	while total > DEF_WARP_CACHE_BYTES:
+		total -= _map_nbytes(_WARP_CACHE.popitem(last=False)[1])
 
 
-# if (xmod = 2, ymod = 0) then xstart = 2, xend = h
-# TODO: test on real example
-def translate(img, xmod, ymod, fill='background', fill_value=None):
+# pixel (i, j) of img moves to (i + xmod, j + ymod), uncovered pixels take fill_value
+def _shift(img, xmod, ymod, fill_value, img_mod):
 	h, w = img.shape[:2]
-	img_mod = np.zeros_like(img).astype(np.uint8)
-	# translating the image
 	xstart, xend, nxstart, nxend = max(0, -xmod), min(h, h - xmod), max(0, xmod), min(h, h + xmod)
 	ystart, yend, nystart, nyend = max(0, -ymod), min(w, w - ymod), max(0, ymod), min(w, w + ymod)
-	img_mod[nxstart: nxend, nystart: nyend] = img[xstart: xend, ystart: yend]
-	# processing missing values in translated image
-	if fill_value is not None:
-		img_mod[:nxstart] = fill_value
-		img_mod[nxend:] = fill_value
-		img_mod[:, :nystart] = fill_value
-		img_mod[:, nyend:] = fill_value
-	elif fill == 'black':
-		img_mod[:nxstart] = 0
-		img_mod[nxend:] = 0
-		img_mod[:, :nystart] = 0
-		img_mod[:, nyend:] = 0
-	elif fill == 'white':
-		img_mod[:nxstart] = 255
-		img_mod[nxend:] = 255
-		img_mod[:, :nystart] = 255
-		img_mod[:, nyend:] = 255
-	elif fill == 'background':
-		bg_color = np.array(background_color(im)) 
-		img_mod[:nxstart] = bg_color
-		img_mod[nxend:] = bg_color
-		img_mod[:, :nystart] = bg_color
-		img_mod[:, nyend:] = bg_color
-	elif fill == 'mirror':
-		img_mod[:nxstart] = img[:nxstart:-1]
-		img_mod[nxend:] = img[nxend::-1]
-		img_mod[:, :nystart] = img[:, :nystart:-1]
-		img_mod[:, nyend:] = img[:, nyend::-1]
+	if xend > xstart and yend > ystart:
+		img_mod[nxstart: nxend, nystart: nyend] = img[xstart: xend, ystart: yend]
 	else:
-		return NotImplementedError
+		nxstart = nxend = nystart = nyend = 0
+	img_mod[:nxstart] = fill_value
+	img_mod[nxend:] = fill_value
+	img_mod[:, :nystart] = fill_value
+	img_mod[:, nyend:] = fill_value
 	return img_mod
 
 
-def to_channel(img, channel='r'):
-	if channel.lower() == 'r':
-		img_mod = deepcopy(img)
-		img_mod[:, :, 1:] = 0
-	elif channel.lower() == 'g':
-		img_mod = deepcopy(img)
-		img_mod[:, :, ::2] = 0
-	elif channel.lower() == 'b':
-		img_mod = deepcopy(img)
-		img_mod[:, :, :2] = 0
+# single resampling pass of img through a forward affine matrix (see rotation_matrix & co)
+# order : 'nearest' or 'bilinear'
+# fill : 'black', 'white', 'background' (mode color), or boundary modes 'mirror', 'reflect', 'nearest', 'wrap'
+# named as in scipy.ndimage ('mirror' skips the edge pixel, 'reflect' repeats it)
+# fill_value overrides fill with a constant color
+# coordinate maps are cached per (shape, matrix) so that repeated warps only resample, up to
+# DEF_WARP_CACHE_BYTES of maps
+def warp_affine(img, matrix, out_shape=None, order='nearest', fill='black', fill_value=None, out=None):
+	in_shape = tuple(img.shape[:2])
+	out_shape = in_shape if out_shape is None else tuple(int(d) for d in out_shape)
+	if fill_value is None and fill in ('mirror', 'reflect', 'nearest', 'wrap'):
+		boundary = fill
+	elif fill_value is not None or fill in ('black', 'white', 'background'):
+		boundary = 'constant'
+		if fill_value is None:
+			fill_value = {'black': 0, 'white': 255}.get(fill)
+			if fill == 'background':
+				fill_value = background_color(img)
 	else:
-		err = 'channel argument must be one of `r`, `g` or `b`.'
-		raise ValueError(err)
+		raise ValueError("`fill` expected values are 'black', 'white', 'background', 'mirror', 'reflect', 'nearest' or 'wrap'.")
+	matrix = np.asarray(matrix, dtype=np.float64)
+	if matrix.shape == (2, 3):
+		matrix = np.vstack([matrix, [0., 0., 1.]])
+	full_shape = out_shape + img.shape[2:]
+	if out is not None and (out.shape != full_shape or out.dtype != img.dtype):
+		raise ValueError('`out` should have the output shape and the dtype of the image.')
+	shift = matrix[:2, 2]
+	if boundary == 'constant' and out_shape == in_shape and np.array_equal(matrix[:2, :2], np.eye(2)) \
+			and np.array_equal(shift, np.round(shift)):
+		# integer translations are plain slice copies
+		return _shift(img, int(shift[0]), int(shift[1]), fill_value, np.empty_like(img) if out is None else out)
+	indices, weights, outside = _warp_map(in_shape, out_shape, matrix, order, boundary)
+	src = img.reshape(in_shape[0] * in_shape[1], -1)
+	direct = out is not None and out.flags.c_contiguous and not np.may_share_memory(out, img)
+	img_mod = out if direct else np.empty(full_shape, dtype=img.dtype)
+	flat = img_mod.reshape(len(indices[0]), -1)
+	if weights is None:
+		np.take(src, indices[0], axis=0, out=flat, mode='clip')
+	else:
+		acc = np.zeros(flat.shape, dtype=np.float32)
+		for idx, wt in zip(indices, weights):
+			np.take(src, idx, axis=0, out=flat, mode='clip')
+			acc += wt[:, np.newaxis] * flat
+		acc += 0.5
+		np.copyto(flat, acc, casting='unsafe')
+	if outside is not None:
+		flat[outside] = fill_value
+	if out is not None and not direct:
+		out[:] = img_mod
+		return out
 	return img_mod
 
 
-def map_pixval(img, pix_start, pix_end):
-	img_mod = deepcopy(img)
-	imgh, pval = num_hash(img_mod), num_hash(pix_start)
-	img_mod[imgh == pval] = pix_end
-	return img_mod
-
+# if (xmod = 2, ymod = 0) then pixel (0, 0) moves to (2, 0)
+def translate(img, xmod, ymod, fill='background', fill_value=None, out=None):
+	return warp_affine(img, translation_matrix(xmod, ymod), fill=fill, fill_value=fill_value, out=out)
 
-#TODO: replace PIL functions by own functions !!
-def pixelate(img, **kwargs):
-	img_mod = numpy_to_pil(img)
-	img_size = img_mod.size
 
-	# boost saturation of image 
-	sat_booster = ImageEnhance.Color(img_mod)
-	img_mod = sat_booster.enhance(float(kwargs.get("saturation", 1.25)))
+def to_channel(img, channel='r', out=None):
+	if channel.lower() not in ('r', 'g', 'b'):
+		err = 'channel argument must be one of `r`, `g` or `b`.'
+		raise ValueError(err)
+	img_mod = make_output(img, out)
+	if img_mod is not img:
+		img_mod[:] = img
+	if channel.lower() == 'r':
+		img_mod[..., 1:] = 0
+	elif channel.lower() == 'g':
+		img_mod[..., ::2] = 0
+	else:
+		img_mod[..., :2] = 0
+	return img_mod
 
-	# increase contrast of image
-	contr_booster = ImageEnhance.Contrast(img_mod)
-	img_mod = contr_booster.enhance(float(kwargs.get("contrast", 1.2)))
 
-	# reduce the number of colors used in picture
-	img_mod = img_mod.convert('P', palette=Image.ADAPTIVE, colors=int(kwargs.get("n_colors", 10)))
+def map_pixval(img, pix_start, pix_end, out=None):
+	return remap_colors(img, [pix_start], [pix_end], out=out)
+
+
+# remaps several colors at once : src is either a {src_color: dst_color} mapping or a (K, 3) array,
+# in which case dst is the (K, 3) array of new colors (src itself by default)
+# the image is hashed once and every pixel is looked up among the sorted src keys
+# nearest=True maps the other pixels to the dst color of their nearest src color
+def remap_colors(img, src, dst=None, nearest=False, out=None):
+	if isinstance(src, dict):
+		src, dst = list(src.keys()), list(src.values())
+	src = check_colors(src, to_numpy=True).astype(np.int64)
+	dst = src if dst is None else check_colors(dst, to_numpy=True)
+	if len(src) != len(dst):
+		raise ValueError('`src` and `dst` should have the same number of colors.')
+	keys, first = np.unique(src[:, 0] + 256 * src[:, 1] + 256 ** 2 * src[:, 2], return_index=True)
+	imgh = num_hash(img)
+	pos = np.searchsorted(keys, imgh)
+	np.minimum(pos, len(keys) - 1, out=pos)
+	hit = keys[pos] == imgh
+	img_mod = make_output(img, out)
+	if img_mod is not img:
+		img_mod[:] = img
+	img_mod[hit] = dst[first][pos[hit]]
+	if nearest and not np.all(hit):
+		# queried once per distinct missing color
+		cols, inverse = np.unique(imgh[~hit], return_inverse=True)
+		cols = np.stack([cols % 256, cols // 256 % 256, cols // 256 ** 2], axis=1)
+		_, nearest_idx = cKDTree(src).query(cols)
+		img_mod[~hit] = dst[nearest_idx[inverse]]
+	return img_mod
 
-	# reduce image size
-	superpixel_size = int(kwargs.get("superpixel_size", 10))
-	reduced_size = (img_size[0] // superpixel_size, img_size[1] // superpixel_size)
-	img_mod = img_mod.resize(reduced_size, Image.BICUBIC)
 
-	# resize to original shape to give pixelated look
-	img_mod = img_mod.resize(img_size, Image.BICUBIC)
-	img_mod = img_mod.convert('RGB')
-	img_mod = pil_to_numpy(img_mod)
-	
-	return img_mod
+# saturation and contrast boost, superpixel_size x superpixel_size blocks averaged (partial ones at the
+# right and bottom edges included), then painted with the nearest color of an n_colors palette
+# the palette is fit on the boosted image and cached (see palette.extract_palette), so that reruns with
+# another superpixel_size skip the fit
+# frames of an (N, H, W, 3) stack each get their own palette, as when called frame by frame
+def pixelate(img, superpixel_size=10, n_colors=10, saturation=1.25, contrast=1.2, method='kmeans', seed=None,
+			 out=None):
+	out = modify_vividness(img, saturation, out=out)
+	out = modify_contrast(out, contrast, out=out)
+	size = int(superpixel_size)
+	h, w = img.shape[-3:-1]
+	rows, cols = np.arange(0, h, size), np.arange(0, w, size)
+	sums = np.add.reduceat(np.add.reduceat(out, rows, axis=-3, dtype=np.uint32), cols, axis=-2)
+	areas = np.outer(np.diff(np.append(rows, h)), np.diff(np.append(cols, w)))[..., np.newaxis]
+	means = ((sums + areas // 2) // areas).astype(np.uint8)
+	if out.ndim == 4:
+		blocks = np.stack([extract_palette(frame, n_colors, method, seed=seed).quantize(frame_means)
+						   for frame, frame_means in zip(out, means)])
+	else:
+		blocks = extract_palette(out, n_colors, method, seed=seed).quantize(means)
+	out[:] = np.repeat(np.repeat(blocks, size, axis=-3)[..., :h, :, :], size, axis=-2)[..., :w, :]
+	return out
 
 
-def rotate(img, dg, mode='constant', keep_dims=False):
-	rot_img = interpolation.rotate(img, dg, mode=mode)
+# counter-clockwise rotation around the image center
+# the output is enlarged to fit the whole rotated image unless keep_dims
+# mode : any `fill` of warp_affine, or a scipy.ndimage mode as taken by earlier versions
+# ('constant', 'reflect', 'mirror', 'nearest', 'wrap' and their 'grid-' variants)
+def rotate(img, dg, mode='constant', keep_dims=False, order='bilinear', fill_value=None):
+	h, w = img.shape[:2]
+	rot = rotation_matrix(dg)
 	if keep_dims:
-		rx, ry = rot_img.shape[:2]
-		hx = (rx - img.shape[0]) // 2
-		hy = (ry - img.shape[1]) // 2
-		return rot_img[hx: rx - hx, hy: ry - hy]
-	return rot_img
+		out_shape = (h, w)
+	else:
+		corners = rot[:2, :2] @ np.array([[0, 0, h, h], [0, w, 0, w]])
+		out_shape = tuple((np.ptp(corners, axis=1) + 0.5).astype(int))
+	in_center, out_center = ((h - 1) / 2., (w - 1) / 2.), ((out_shape[0] - 1) / 2., (out_shape[1] - 1) / 2.)
+	matrix = translation_matrix(*out_center) @ rot @ translation_matrix(-in_center[0], -in_center[1])
+	fill = {'constant': 'black', 'grid-constant': 'black', 'grid-mirror': 'reflect', 'grid-wrap': 'wrap'}.get(mode, mode)
+	return warp_affine(img, matrix, out_shape, order=order, fill=fill, fill_value=fill_value)
 
 
 # similar to numpy sort but with an additional key argument
 # key can either be a function or a 1D array / 2D matrix with values
-def sort(img, key, order='increasing'):
+# axis=None sorts the whole image, axis=1 (resp. 0) sorts pixels within each row (resp. column)
+# only pixels of mask are sorted, by spans of consecutive masked pixels along axis (glitch sort)
+# mask can be given as a (low, high) threshold on the luminance (0 - 255) or hue (0 - 1) of pixels, see `by`
+# spans are sorted all at once, on (span id, key) : keys are replaced by their rank so that both fit
+# in a single integer key (same order as a lexsort, about twice as fast)
+def sort(img, key, order='increasing', axis=None, mask=None, threshold=None, by='luminance'):
+	h, w = img.shape[:2]
 	if callable(key):
+		# per pixel keys are only evaluated once per distinct color
 		try:
 			vals = key(img)
 		except:
-			h, w = img.shape[:2]
-			vals = np.array([key(img[i, j]) for i in range(h) for j in range(w)])
+			vals = map_unique_colors(img, key)
 	elif type(key) is np.ndarray:
 		vals = key
-	
-	if vals.ndim == 1:
-		indices = np.argsort(vals)
-	elif vals.ndim == 2:
-		indices = np.argsort(np.ravel(vals))
-	else:
+	if vals.ndim not in (1, 2):
 		raise ValueError('Indices for sorting should be a 1d or 2d array.')
-	
+	vals = np.ravel(vals)
 	if order == 'reverse' or order == 'decreasing':
-		indices = indices[::-1]
-
-	img_mod = deepcopy(img).reshape(img.shape[0] * img.shape[1], img.shape[2])
-	img_mod = img.mod[indices].reshape(img.shape[0], img.shape[1], img.shape[2])
-	
-	return img_mod
+		vals = -vals.astype(np.float64)
+
+	if threshold is not None:
+		if by == 'luminance':
+			channel = img_to_luminance(img)
+		elif by == 'hue':
+			channel = img_to_hue(img)
+		else:
+			raise ValueError("`by` expected values are 'luminance' or 'hue'.")
+		mask = (channel >= threshold[0]) & (channel <= threshold[1])
+	elif mask is None:
+		mask = np.ones((h, w), dtype=bool)
+	# flat positions of pixels, in the order of spans
+	positions = np.arange(h * w).reshape(h, w)
+	if axis == 0:
+		positions, mask = positions.T, mask.T
+	elif axis not in (None, 1):
+		raise ValueError('`axis` expected values are None, 0 or 1.')
+	selected = np.flatnonzero(mask)
+	indices = np.ravel(positions)[selected]
+	if axis is None:
+		spans = np.zeros(len(indices), dtype=np.int64)
+	else:
+		starts = mask.copy()
+		starts[:, 1:] &= ~mask[:, :-1]
+		spans = np.cumsum(np.ravel(starts))[selected]
+
+	ranks = np.empty(len(indices), dtype=np.int64)
+	ranks[np.argsort(vals[indices], kind='stable')] = np.arange(len(indices))
+	img_mod = deepcopy(img).reshape(h * w, -1)
+	img_mod[indices] = img.reshape(h * w, -1)[indices[np.argsort(spans * len(indices) + ranks)]]
+	return img_mod.reshape(img.shape)
+
+
+# colors of pixels bucketed on a (2 ** bits) ** 3 grid, for nearest color queries
+# a color is identified by the (flat) position of its pixel, keys are the bucket keys of all positions
+# buckets are contiguous segments of pool, whose first live[k] entries are the colors not taken yet
+# colors are taken from the end of their bucket, so that a whole batch of queries is served at once
+class _ColorBuckets:
+
+	def __init__(self, keys, positions, bits):
+		n_buckets = 2 ** (3 * bits)
+		self.keys = keys
+		self.pool = positions[np.argsort(keys[positions], kind='stable')]
+		counts = np.bincount(keys[positions], minlength=n_buckets)
+		self.starts = np.cumsum(counts) - counts
+		# bucket n_buckets is always empty, it stands for the neighbours outside of the grid
+		self.live = np.append(counts, 0)
+		self.slots = np.zeros(len(keys), dtype=np.int64)
+		self.slots[self.pool] = np.arange(len(self.pool))
+		size = 2 ** bits
+		self.grid = np.stack(np.unravel_index(np.arange(n_buckets), (size,) * 3), axis=1)
+		# keys of the 26 neighbouring buckets of each bucket, closest first
+		deltas = np.stack(np.unravel_index(np.arange(27), (3, 3, 3)), axis=1) - 1
+		deltas = deltas[np.argsort(np.sum(deltas ** 2, axis=1), kind='stable')][1:]
+		neighs = self.grid[:, np.newaxis, :] + deltas
+		valid = np.all((neighs >= 0) & (neighs < size), axis=2)
+		self._tree = None
+		self.neighbours = np.where(valid, np.ravel_multi_index(np.clip(neighs, 0, size - 1).transpose(2, 0, 1),
+															   (size,) * 3), n_buckets).astype(np.int32)
+
+	# removes one given color (swapped with the last live color of its bucket)
+	def remove(self, pos):
+		key = self.keys[pos]
+		last = self.starts[key] + self.live[key] - 1
+		slot = self.slots[pos]
+		other = self.pool[last]
+		self.pool[slot], self.pool[last] = other, pos
+		self.slots[other], self.slots[pos] = slot, last
+		self.live[key] -= 1
+
+	# nonempty buckets closest to buckets keys : the buckets themselves, their neighbours,
+	# then the nearest nonempty bucket of the whole grid
+	def _nearest(self, keys):
+		keys = keys.copy()
+		empty = np.flatnonzero(self.live[keys] == 0)
+		if len(empty):
+			neighs = self.neighbours[keys[empty]]
+			found = self.live[neighs] > 0
+			has = found.any(axis=1)
+			keys[empty[has]] = neighs[has, np.argmax(found[has], axis=1)]
+			far = empty[~has]
+			if len(far):
+				keys[far] = self._far(keys[far])
+		return keys
+
+	# the tree over nonempty buckets is kept while its nearest candidates still hold colors,
+	# and rebuilt over the buckets left nonempty otherwise
+	def _far(self, keys):
+		res = np.empty(len(keys), dtype=np.int64)
+		pending = np.arange(len(keys))
+		while len(pending):
+			if self._tree is None:
+				self._tree_keys = np.flatnonzero(self.live[:-1] > 0)
+				self._tree = cKDTree(self.grid[self._tree_keys])
+			k = min(PIXELSORT_TREE_K, len(self._tree_keys))
+			cands = self._tree_keys[self._tree.query(self.grid[keys[pending]], k=k)[1].reshape(len(pending), k)]
+			found = self.live[cands] > 0
+			has = found.any(axis=1)
+			res[pending[has]] = cands[has, np.argmax(found[has], axis=1)]
+			pending = pending[~has]
+			if len(pending):
+				self._tree = None
+		return res
+
+	# takes one color per query, as close as possible to the color of bucket keys[i]
+	# queries exceeding what is left in a bucket are sent to the next nearest bucket
+	def take(self, keys):
+		taken = np.empty(len(keys), dtype=np.int64)
+		pending = np.arange(len(keys))
+		while len(pending):
+			targets = self._nearest(keys[pending])
+			order = np.argsort(targets, kind='stable')
+			targets, pending = targets[order], pending[order]
+			first = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+			ranks = np.arange(len(targets)) - np.repeat(first, np.diff(np.r_[first, len(targets)]))
+			served = ranks < self.live[targets]
+			taken[pending[served]] = self.pool[self.starts[targets[served]] + self.live[targets[served]]
+											   - 1 - ranks[served]]
+			self.live[targets[first]] -= np.minimum(np.diff(np.r_[first, len(targets)]), self.live[targets[first]])
+			pending = pending[~served]
+		return taken
+
+	# colors not taken yet
+	def left(self):
+		counts = self.live[:-1]
+		idx = np.repeat(self.starts - np.cumsum(np.r_[0, counts[:-1]]), counts) + np.arange(counts.sum())
+		return self.pool[idx]
 
 
 # from https://twitter.com/kGolid/status/1060841706105507840
-def pixelsort(img):
-	# select some starting pixel pst
-	# draw randomly from neighborhood of processed pixels
-	# pick the farthest from pst -> P
-	# draw randomly from unprocessed
-	# pick the most similar to the processed neighbor of P ->
-	# swap P and S
+# grows a processed region from a starting pixel : at each step a few pixels are drawn on the frontier
+# of the region and the farthest from the start P is processed, by giving it the color, among the
+# unprocessed pixels, closest to the one of a processed neighbour of P
+# steps run by batches : a `batch` fraction of the frontier is drawn at once, by groups of n_candidates
+# closest colors are found through a color bucket grid of 2 ** bits levels per channel
+# (by default about 16 pixels per bucket, between 3 and 6 bits)
+# n_iter bounds the number of processed pixels (all of them by default), the colors that were not given
+# stay in place on unprocessed pixels, or fill the unprocessed pixels whose color was given away
+def pixelsort(img, start=None, n_iter=None, n_candidates=4, bits=None, batch=DEF_PIXELSORT_BATCH, seed=None):
 	h, w = img.shape[:2]
-	img_mod = deepcopy(img)
-	x_start, y_start = np.random.randint(h), np.random.randint(w)
-	orig = (x_start, y_start)
-	proc = set(orig)
-	unproc = set([(i, j) for i in range(h) for j in range(w)]) - proc
-	neigh = set((x_start - 1, y_start),
-				(x_start + 1, y_start),
-				(x_start, y_start - 1),
-				(x_start, y_start + 1))
-	sources = sample_from_set(neigh, size=4)
-	src = sources[np.argmax([dist(cd, orig) for cd in sources])]
-	dests = sample_from_set(unproc, size=4)
-	dst = dests[np.argmax([sim(cd, src) for cd in dests])]
-	img_mod[src[0], src[1]], img_mod[dst[0], dst[1]] = img_mod[dst[0], dst[1]], img_mod[src[0], src[1]]
-	proc.add(src)
-	unproc.remove(src)
-
-
+	if bits is None:
+		bits = min(6, max(3, int(math.log2(max(h * w / 16, 1)) / 3)))
+	rng = np.random.RandomState(seed)
+	# positions index a grid padded by one pixel, so that the 4 neighbours of a pixel always exist
+	pw = w + 2
+	flat = np.pad(img, ((1, 1), (1, 1), (0, 0))).reshape(-1, 3)
+	keys = flat.astype(np.int64) >> (8 - bits)
+	keys = (keys[:, 0] << (2 * bits)) | (keys[:, 1] << bits) | keys[:, 2]
+	# 0 : unprocessed, 1 : frontier (unprocessed), 2 : processed, 3 : padding
+	state = np.full((h + 2, pw), 3, dtype=np.uint8)
+	state[1: -1, 1: -1] = 0
+	state = np.ravel(state)
+	inside = np.flatnonzero(state == 0)
+	buckets = _ColorBuckets(keys, inside, bits)
+	# position of the color given to each processed pixel
+	given = np.full(len(state), -1, dtype=np.int64)
+
+	r0, c0 = (rng.randint(h), rng.randint(w)) if start is None else start
+	rows, cols = np.divmod(np.arange(len(state)), pw)
+	dists = (rows - r0 - 1) ** 2 + (cols - c0 - 1) ** 2
+	pos = (r0 + 1) * pw + c0 + 1
+	buckets.remove(pos)
+	given[pos] = pos
+	state[pos] = 2
+	steps = np.array([-pw, pw, -1, 1])
+	frontier = pos + steps
+	frontier = frontier[state[frontier] == 0]
+	state[frontier] = 1
+	n_iter = h * w - 1 if n_iter is None else n_iter
+	done = 0
+	while len(frontier) and done < n_iter:
+		n_draws = min(n_iter - done, max(1, int(batch * len(frontier))))
+		draws = frontier[rng.randint(len(frontier), size=(n_draws, n_candidates))]
+		picked = np.unique(draws[np.arange(n_draws), np.argmax(dists[draws], axis=1)])
+		neighs = picked[:, np.newaxis] + steps
+		# the reference is a random processed neighbour, which avoids streaks along a preferred direction
+		weights = (state[neighs] == 2) * rng.random_sample(neighs.shape)
+		refs = neighs[np.arange(len(picked)), np.argmax(weights, axis=1)]
+		state[picked] = 2
+		given[picked] = buckets.take(keys[given[refs]])
+		done += len(picked)
+		new = np.unique(neighs[state[neighs] == 0])
+		state[new] = 1
+		frontier = np.concatenate([frontier[state[frontier] == 1], new])
+	res = flat.copy()
+	processed = np.flatnonzero(state == 2)
+	res[processed] = flat[given[processed]]
+	left = buckets.left()
+	unprocessed = (state == 0) | (state == 1)
+	in_place = np.zeros(len(state), dtype=bool)
+	in_place[left] = True
+	moved = left[~unprocessed[left]]
+	res[np.flatnonzero(unprocessed & ~in_place)] = flat[moved]
+	return res.reshape(h + 2, pw, 3)[1: -1, 1: -1].copy()
+
+
+# (N, H, W, 3) stacks get one permutation per image
+# pixels are shuffled in place (frame by frame for an (N, H, W, 3) stack), the shuffled image is returned
 def shuffle_pixels(img):
+	if img.ndim == 4:
+		n, h, w = img.shape[:3]
+		perms = np.argsort(np.random.random((n, h * w)), axis=1)
+		pixels = img.reshape(n, h * w, -1)
+		pixels[...] = np.take_along_axis(pixels, perms[:, :, np.newaxis], axis=1)
+		return pixels.reshape(img.shape)
 	h, w = img.shape[:2]
 	pixels = img.reshape((h * w, -1))
 	np.random.shuffle(pixels)
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+import hashlib
+from imgproc.utils import check_colors, check_img_arg, make_output
+import numpy as np
+from scipy.spatial import cKDTree
+
+DEF_SAMPLE_SIZE = 20000
+DEF_BATCH_SIZE = 1024
+DEF_N_ITER = 50
+DEF_LUT_BITS = 5
+DEF_PALETTE_CACHE_SIZE = 16
+
+_PALETTE_CACHE = OrderedDict()
+
+
+# random subsample of the pixels of an image (or stack), as (n, 3) float32
+def sample_pixels(img, sample_size=DEF_SAMPLE_SIZE, seed=None):
+	pixels = img.reshape(-1, 3)
+	if sample_size is not None and len(pixels) > sample_size:
+		pixels = pixels[np.random.RandomState(seed).randint(len(pixels), size=sample_size)]
+	return pixels.astype(np.float32)
+
+
+# median cut (Heckbert, 1982) : the box of pixels with the widest channel range is split at its median
+# along that channel until there are n_colors boxes, whose means make the palette
+# fewer colors are returned when there are not enough distinct pixels to split
+def median_cut(pixels, n_colors):
+	boxes = [np.asarray(pixels, dtype=np.float32)]
+	while len(boxes) < n_colors:
+		ranges = [np.ptp(box, axis=0).max() if len(box) > 1 else 0. for box in boxes]
+		i = int(np.argmax(ranges))
+		if ranges[i] == 0:
+			break
+		box = boxes.pop(i)
+		channel = np.argmax(np.ptp(box, axis=0))
+		box = box[np.argsort(box[:, channel], kind='mergesort')]
+		boxes += [box[:len(box) // 2], box[len(box) // 2:]]
+	return np.array([box.mean(axis=0) for box in boxes], dtype=np.float32)
+
+
+# mini-batch k-means (Sculley, 2010) started from the median cut palette
+# each center moves towards the pixels of a batch assigned to it with a rate decaying with its total count
+def kmeans(pixels, n_colors, batch_size=DEF_BATCH_SIZE, n_iter=DEF_N_ITER, seed=None):
+	pixels = np.asarray(pixels, dtype=np.float32)
+	centers = median_cut(pixels, n_colors)
+	counts = np.zeros(len(centers))
+	rng = np.random.RandomState(seed)
+	for _ in range(n_iter):
+		batch = pixels[rng.randint(len(pixels), size=min(batch_size, len(pixels)))]
+		labels = cKDTree(centers).query(batch)[1]
+		n_batch = np.bincount(labels, minlength=len(centers))
+		counts += n_batch
+		seen = n_batch > 0
+		sums = np.stack([np.bincount(labels, weights=batch[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+		centers[seen] += (sums[seen] - n_batch[seen, np.newaxis] * centers[seen]) / counts[seen, np.newaxis]
+	return centers
+
+
+# a set of colors, with a (2 ** bits) ** 3 LUT from the `bits` most significant bits of each channel
+# to the nearest color, built on first use
+class Palette:
+
+	def __init__(self, colors, bits=DEF_LUT_BITS):
+		self.colors = np.clip(np.round(check_colors(colors, to_numpy=True)), 0, 255).astype(np.uint8)
+		if not len(self.colors):
+			raise ValueError('A palette needs at least one color.')
+		self.bits = bits
+		self._lut = None
+
+	def __len__(self):
+		return len(self.colors)
+
+	def __repr__(self):
+		return 'Palette({} colors)'.format(len(self))
+
+	@property
+	def lut(self):
+		if self._lut is None:
+			n_bins = 2 ** self.bits
+			step = 2 ** (8 - self.bits)
+			centers = np.stack(np.meshgrid(*[np.arange(n_bins)] * 3, indexing='ij'), axis=-1) * step + step // 2
+			idx = cKDTree(self.colors.astype(np.float32)).query(centers.reshape(-1, 3))[1]
+			self._lut = idx.astype(np.uint8 if len(self) <= 256 else np.uint16)
+		return self._lut
+
+	# palette index of each pixel of an image (or stack)
+	def index(self, img):
+		shift = 8 - self.bits
+		key = (img[..., 0] >> shift).astype(np.intp) << (2 * self.bits)
+		key |= (img[..., 1] >> shift).astype(np.intp) << self.bits
+		key |= img[..., 2] >> shift
+		return np.take(self.lut, key, mode='clip')
+
+	def quantize(self, img, out=None):
+		out = make_output(img, out)
+		np.take(self.colors, self.index(img), axis=0, out=out, mode='clip')
+		return out
+
+
+# palette of n_colors fit on a subsample of img with method 'kmeans' or 'median_cut'
+# palettes are kept in a small LRU cache keyed by the image contents and parameters, so that
+# ops rerun on the same image with other parameters skip the fit
+def extract_palette(img, n_colors=10, method='kmeans', sample_size=DEF_SAMPLE_SIZE, seed=None):
+	check_img_arg(img, allow_batch=True)
+	if method not in ('kmeans', 'median_cut'):
+		raise ValueError("method should be either 'kmeans' or 'median_cut'.")
+	img = np.ascontiguousarray(img)
+	key = (hashlib.sha1(img.data).hexdigest(), img.shape, n_colors, method, sample_size, seed)
+	if key in _PALETTE_CACHE:
+		_PALETTE_CACHE.move_to_end(key)
+		return _PALETTE_CACHE[key]
+	pixels = sample_pixels(img, sample_size, seed)
+	if method == 'kmeans':
+		palette = Palette(kmeans(pixels, n_colors, seed=seed))
+	else:
+		palette = Palette(median_cut(pixels, n_colors))
+	_PALETTE_CACHE[key] = palette
+	if len(_PALETTE_CACHE) > DEF_PALETTE_CACHE_SIZE:
+		_PALETTE_CACHE.popitem(last=False)
+	return palette
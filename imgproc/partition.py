@@ -1,19 +1,153 @@
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import deepcopy
-from imgproc.utils import check_color, is_iterable, make_canvas
-import itertools
+import hashlib
+from imgproc.color import rgb_to_lab
+from imgproc.utils import check_color, check_colors, is_iterable, make_canvas
+import math
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import os
 import random
-from sklearn.neighbors import NearestNeighbors
+import tempfile
+import weakref
+from scipy.ndimage import distance_transform_edt
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+DEF_CHUNK_SIZE = 2 ** 18
+DEF_SCRATCH_SIZE = 2 ** 16 * 3
+DEF_PLAN_CACHE_SIZE = 4
+
+_PLAN_CACHE = OrderedDict()
+
+
+# groups flat pixel indices by label with a single stable sort
+# cell i gathers order[offsets[i]: offsets[i + 1]], in row-major order
+def _group_by_label(labels, n_labels):
+	flat = np.ravel(labels)
+	if n_labels <= 2 ** 16:
+		# radix sort kicks in for small integer types
+		flat = flat.astype(np.uint16)
+	order = np.argsort(flat, kind='stable')
+	counts = np.bincount(flat, minlength=n_labels)[:n_labels]
+	offsets = np.zeros(n_labels + 1, dtype=np.int64)
+	np.cumsum(counts, out=offsets[1:])
+	return order, offsets
+
+
+def _check_palette(palette, n_regions):
+	palette = check_colors(palette, to_numpy=True)
+	if len(palette) != n_regions:
+		raise IndexError('Palette should hold one color per region ({}).'.format(n_regions))
+	return palette.astype(np.uint8, copy=False)
+
+
+def _cell_from_flat(img, flat_idx):
+	rows, cols = np.divmod(flat_idx, img.shape[1])
+	return Cell(img[rows, cols], rows, cols)
+
+
+# regions are (block, slices) or (cell, (rows, cols)) pairs locating each region in the image
+def _region_pixels(region):
+	if isinstance(region, Block):
+		return region.img
+	return region.vals
+
+
+def _load_region(region, key, out):
+	if isinstance(region, Block):
+		if region.inplace:
+			region.img[...] = out[key]
+		else:
+			region.img = out[key]
+	else:
+		region.vals = out[key]
+	_mark_modified(region)
+
+
+def _apply_region(region, key, func, out):
+	region.apply(func)
+	out[key] = _region_pixels(region)
+	_load_region(region, key, out)
+
+
+# multiprocessing.shared_memory (python >= 3.8) is only imported by the process backend
+def _shared_array(shape, dtype):
+	from multiprocessing import shared_memory
+	size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+	shm = shared_memory.SharedMemory(create=True, size=size)
+	return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# runs in a worker process, regions are rebuilt from the shared input buffer
+def _apply_shared(src_name, out_name, shape, dtype, func, is_block, key):
+	from multiprocessing import shared_memory
+	src_shm = shared_memory.SharedMemory(name=src_name)
+	out_shm = shared_memory.SharedMemory(name=out_name)
+	try:
+		src = np.ndarray(shape, dtype=dtype, buffer=src_shm.buf)
+		out = np.ndarray(shape, dtype=dtype, buffer=out_shm.buf)
+		if is_block:
+			region = Block(src[key].copy())
+		else:
+			region = Cell(src[key], *key)
+		region.apply(func)
+		out[key] = _region_pixels(region)
+		del src, out
+	finally:
+		src_shm.close()
+		out_shm.close()
+
+
+# apply_to_all processes regions concurrently (with threads or processes) when given more than one worker
+def _is_parallel(workers):
+	return workers is not None and workers > 1
+
+
+# regions are independent so they can be processed concurrently, every result is written
+# into one preallocated output image which the regions then view (blocks) or gather from (cells)
+# func must preserve region shapes, and be picklable for the process backend
+def _apply_parallel(regions, func, img, workers, backend):
+	if backend == 'thread':
+		out = np.empty_like(img)
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [executor.submit(_apply_region, region, key, func, out) for region, key in regions]
+			for future in futures:
+				future.result()
+	elif backend == 'process':
+		(src_shm, src), (out_shm, out) = [_shared_array(img.shape, img.dtype) for _ in range(2)]
+		try:
+			for region, key in regions:
+				src[key] = _region_pixels(region)
+			tasks = [(src_shm.name, out_shm.name, img.shape, img.dtype, func, isinstance(region, Block), key)
+					 for region, key in regions]
+			chunksize = max(1, len(tasks) // (4 * workers))
+			with ProcessPoolExecutor(max_workers=workers) as executor:
+				list(executor.map(_apply_shared, *zip(*tasks), chunksize=chunksize))
+			result = np.array(out)
+		finally:
+			del src, out
+			for shm in (src_shm, out_shm):
+				shm.close()
+				shm.unlink()
+		for region, key in regions:
+			_load_region(region, key, result)
+	else:
+		raise ValueError("`backend` expected values are 'thread' or 'process'.")
 
 
 # defines a rectangular patch of image that can be represented as a numpy array
 class Block:
 
 	# coords are coordinates of opposite corners (as a 2D array or alike)
-	def __init__(self, img, coords=None):
+	# inplace blocks write modifications back into the buffer they view
+	def __init__(self, img, coords=None, inplace=False):
 		self.img = img
 		self.coords = coords
+		self.inplace = inplace
+		self._owner = None
 
 	def __len__(self):
 		return len(self.img)
@@ -23,7 +157,7 @@ class Block:
 		if self.coords is None:
 			# raise AttributeError('Need to specify `coords` attribute when defining Block.')
 			return None
-		return np.mean(coords, axis=0)
+		return np.mean(self.coords, axis=0)
 
 	@property
 	def shape(self):
@@ -31,11 +165,20 @@ class Block:
 
 	#TODO: mfunc for morphing function ? better name ?
 	def apply(self, mfunc):
-		self.img = mfunc(self.img, **self._kwargs())
+		mod_img = mfunc(self.img, **self._kwargs())
+		if self.inplace:
+			self.img[...] = mod_img
+		else:
+			self.img = mod_img
+		_mark_modified(self)
 
 	def paint(self, col):
 		check_color(col)
-		self.img = np.tile(col, (self.shape[0], self.shape[1], 1))
+		if self.inplace:
+			self.img[...] = col
+		else:
+			self.img = np.tile(col, (self.shape[0], self.shape[1], 1))
+		_mark_modified(self)
 
 	def _kwargs(self):
 		kwargs = dict(
@@ -47,45 +190,123 @@ class Block:
 
 # defines connected group of pixels of arbitrary shape
 # inspiration : sparse matrix representation
+# rows / cols are stored as uint16 when possible (int32 otherwise) and are not meant to be
+# modified after creation since the bounding box is computed once
 class Cell:
 
+	__slots__ = ('vals', 'rows', 'cols', '_mrow', '_mcol', '_vshape', '_local', '_scratch', '_owner')
+
 	def __init__(self, vals, rows, cols):
 		assert len(vals) == len(rows)
 		assert len(vals) == len(cols)
 		self.vals = vals
-		self.rows = rows
-		self.cols = cols
+		self.rows, self._mrow, rmax = _compact_indices(rows)
+		self.cols, self._mcol, cmax = _compact_indices(cols)
+		self._vshape = (rmax - self._mrow + 1, cmax - self._mcol + 1, 3)
+		self._local = None
+		self._scratch = None
+		self._owner = None
 
 	def __len__(self):
 		return len(self.vals)
 
 	@property
 	def mrow(self):
-		return np.min(self.rows)
+		return self._mrow
 
 	@property
 	def mcol(self):
-		return np.min(self.cols)
+		return self._mcol
 
 	@property
 	def vshape(self):
-		rm, rx = self.mrow, np.max(self.rows)
-		cm, cx = self.mcol, np.max(self.cols)
-		return (rx - rm + 1, cx - cm + 1, 3)
+		return self._vshape
 
+	# coordinates relative to the bounding box
+	@property
+	def local(self):
+		if self._local is None:
+			self._local = (self.rows - self._mrow, self.cols - self._mcol)
+		return self._local
+
+	# small cells keep their view buffer from one call to the next
 	def _view(self):
-		view = np.zeros(self.vshape).astype(np.uint8)
-		view[self.rows - self.mrow, self.cols - self.mcol] = self.vals
+		view = self._scratch
+		if view is None:
+			view = np.zeros(self.vshape, dtype=np.uint8)
+			if view.size <= DEF_SCRATCH_SIZE:
+				self._scratch = view
+		else:
+			view.fill(0)
+		view[self.local] = self.vals
 		return view
 
 	#TODO: mfunc for morphing function ? better name ?
 	def apply(self, mfunc):
 		mod_view = mfunc(self._view())
-		self.vals = mod_view[self.rows - self.mrow, self.cols - self.mcol]
+		self.vals = mod_view[self.local]
+		_mark_modified(self)
 	
 	def paint(self, col):
 		check_color(col)
 		self.vals = np.tile(col, (len(self), 1))
+		_mark_modified(self)
+
+
+# returns indices in the smallest fitting type along with their min and max
+def _compact_indices(idx):
+	idx = np.asarray(idx)
+	if idx.size == 0:
+		return idx.astype(np.uint16), 0, -1
+	m, mx = int(idx.min()), int(idx.max())
+	dtype = np.uint16 if 0 <= m and mx < 2 ** 16 else np.int32
+	return idx.astype(dtype, copy=False), m, mx
+
+
+# list-like container materializing regions (blocks or cells) on first access
+# unmodified regions live in a LRU cache of at most `cache_size` regions (unbounded if None)
+# modified regions are kept aside until the divider is stitched, so edits are never dropped
+class LazyRegions:
+
+	def __init__(self, get_region, n_regions, cache_size=None):
+		self._get_region = get_region
+		self._n_regions = n_regions
+		self.cache_size = cache_size
+		self._cache = OrderedDict()
+		self.modified = {}
+
+	def __len__(self):
+		return self._n_regions
+
+	def __iter__(self):
+		return (self[i] for i in range(len(self)))
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		if not 0 <= i < len(self):
+			raise IndexError('Exceeded actual amount of regions.')
+		if i in self.modified:
+			return self.modified[i]
+		elif i in self._cache:
+			self._cache.move_to_end(i)
+			return self._cache[i]
+		region = self._get_region(i)
+		region._owner = (self, i)
+		self._cache[i] = region
+		if self.cache_size is not None and len(self._cache) > self.cache_size:
+			self._cache.popitem(last=False)
+		return region
+
+	def _pin(self, i, region):
+		self._cache.pop(i, None)
+		self.modified[i] = region
+
+
+def _mark_modified(region):
+	if region._owner is not None:
+		owner, i = region._owner
+		owner._pin(i, region)
 
 
 # question : does it take additional memory to give Band an indexed numpy array
@@ -93,12 +314,17 @@ class Cell:
 # answer : no copy but have to be careful not to erase original values in image
 class BandDivider:
 
-	def __init__(self, img, indices, btype='horizontal'):
+	# lazy dividers only build a band when it is accessed (see LazyRegions)
+	def __init__(self, img, indices, btype='horizontal', lazy=False, cache_size=None):
 		self.img = img
 		self.indices = indices
 		self._remove_duplicates(sort=True)
 		self.btype = btype
-		self.bands = self._divide_into_bands()
+		self.lazy = lazy
+		if lazy:
+			self.bands = LazyRegions(self._get_band, self.n_bands, cache_size)
+		else:
+			self.bands = self._divide_into_bands()
 		self._curr = 0
 
 	def __iter__(self):
@@ -154,9 +380,38 @@ class BandDivider:
 			err = 'Only `horizontal` and `vertical` modes are supported at the moment.'
 			raise NotImplementedError(err)
 
-	def apply_to_all(self, func):
-		for band in self:
-			band.apply(func)
+	def _regions(self):
+		bounds = [None] + list(self.indices) + [None]
+		slices = [slice(bounds[i], bounds[i + 1]) for i in range(self.n_bands)]
+		if self.btype == 'vertical':
+			return [(band, (slice(None), sl)) for band, sl in zip(self.bands, slices)]
+		return [(band, (sl,)) for band, sl in zip(self.bands, slices)]
+
+	def apply_to_all(self, func, workers=None, backend='thread'):
+		if _is_parallel(workers):
+			_apply_parallel(self._regions(), func, self.img, workers, backend)
+		else:
+			for band in self:
+				band.apply(func)
+
+	# band index of each row (horizontal) or column (vertical)
+	def _line_labels(self):
+		size = self.img.shape[0] if self.btype == 'horizontal' else self.img.shape[1]
+		bounds = np.concatenate([[0], np.clip(self.indices, 0, size), [size]])
+		return np.repeat(np.arange(self.n_bands, dtype=np.int32), np.diff(bounds))
+
+	def to_label_image(self):
+		labels = self._line_labels()
+		if self.btype == 'horizontal':
+			return np.repeat(labels[:, np.newaxis], self.img.shape[1], axis=1)
+		return np.repeat(labels[np.newaxis, :], self.img.shape[0], axis=0)
+
+	# renders bands painted with a (n_bands, 3) palette in one pass, bands are left untouched
+	def render_palette(self, palette):
+		line_cols = _check_palette(palette, self.n_bands)[self._line_labels()]
+		if self.btype == 'horizontal':
+			return np.repeat(line_cols[:, np.newaxis], self.img.shape[1], axis=1)
+		return np.repeat(line_cols[np.newaxis, :], self.img.shape[0], axis=0)
 
 	def stitch(self):
 		if self.btype == 'horizontal':
@@ -173,11 +428,22 @@ class BandDivider:
 class RegularGridDivider:
 
 	# cell_size is a tuple/iterable of two elememnts
-	def __init__(self, img, block_size):
+	# strided mode exposes blocks as a (rows, cols, bh, bw, 3) view of img : edits land
+	# directly in img, vectorized functions run over all blocks at once and stitch is free
+	# lazy dividers only build a block when it is accessed (see LazyRegions), blocks
+	# are then indexed by their flat index i * n_col_blocks + j
+	def __init__(self, img, block_size, strided=False, lazy=False, cache_size=None):
 		self.img = img
 		self.block_size = block_size
+		self.strided = strided
+		self.lazy = lazy and not strided
 		self._check_block_size()
-		self.blocks = self._divide_into_blocks()
+		if strided:
+			self.blocks = self._strided_view()
+		elif self.lazy:
+			self.blocks = LazyRegions(self._get_flat_block, self.n_blocks, cache_size)
+		else:
+			self.blocks = self._divide_into_blocks()
 		self._curr = 0
 
 	def __iter__(self):
@@ -190,7 +456,7 @@ class RegularGridDivider:
 		else:
 			i, j = self._curr // self.n_col_blocks, self._curr % self.n_col_blocks
 			self._curr += 1
-			return self.blocks[i][j]
+			return self._block(i, j)
 
 	def __getitem__(self, iter_):
 		i, j = iter_
@@ -198,7 +464,7 @@ class RegularGridDivider:
 			raise IndexError('Exceeded actual amount of blocks per row.')
 		elif j > self.n_col_blocks - 1:
 			raise IndexError('Exceeded actual amount of blocks per column.')
-		return self.blocks[i][j]
+		return self._block(i, j)
 
 	def __len__(self):
 		return self.n_row_blocks
@@ -239,19 +505,52 @@ class RegularGridDivider:
 		sr, sc = self.block_size
 		return Block(self.img[i * sr: (i + 1) * sr, j * sc: (j + 1) * sc])
 
+	def _get_flat_block(self, ind):
+		return self._get_block(ind // self.n_col_blocks, ind % self.n_col_blocks)
+
+	def _strided_view(self):
+		sr, sc = self.block_size
+		s0, s1, s2 = self.img.strides
+		shape = (self.n_row_blocks, self.n_col_blocks, sr, sc, self.img.shape[2])
+		return as_strided(self.img, shape=shape, strides=(s0 * sr, s1 * sc, s0, s1, s2))
+
+	def _block(self, i, j):
+		if self.strided:
+			return Block(self.blocks[i, j], inplace=True)
+		elif self.lazy:
+			return self.blocks[i * self.n_col_blocks + j]
+		return self.blocks[i][j]
+
+	def _check_vectorized(self, vectorized):
+		if vectorized and not self.strided:
+			raise ValueError('Vectorized functions require a divider built with `strided=True`.')
+		return vectorized
+
 	def _random_block_index(self):
 		return (random.randint(0, self.n_row_blocks - 1), random.randint(0, self.n_col_blocks - 1))
 
+	# flat block indices sampled without replacement, so that the (row, col) grid is never listed
 	def _random_block_indices(self, num_samples):
-		all_block_indices = list(itertools.product(np.arange(self.n_row_blocks), np.arange(self.n_col_blocks)))
-		samples = np.random.permutation(np.arange(self.n_blocks))[:num_samples]
-		return [all_block_indices[ind] for ind in samples]
+		samples = np.random.choice(self.n_blocks, min(num_samples, self.n_blocks), replace=False)
+		rows, cols = np.divmod(samples, self.n_col_blocks)
+		return list(zip(rows.tolist(), cols.tolist()))
 
-	def apply_to_all(self, func):
-		for block in self:
-			block.apply(func)
+	def _regions(self):
+		sr, sc = self.block_size
+		return [(self._block(i, j), (slice(i * sr, (i + 1) * sr), slice(j * sc, (j + 1) * sc)))
+				for i in range(self.n_row_blocks) for j in range(self.n_col_blocks)]
+
+	# vectorized functions receive and return a (n_blocks, bh, bw, 3)-like array of blocks
+	def apply_to_all(self, func, vectorized=False, workers=None, backend='thread'):
+		if self._check_vectorized(vectorized):
+			self.blocks[...] = func(self.blocks)
+		elif _is_parallel(workers):
+			_apply_parallel(self._regions(), func, self.img, workers, backend)
+		else:
+			for block in self:
+				block.apply(func)
 
-	def apply_to_random_sample(self, func, num_samples):
+	def apply_to_random_sample(self, func, num_samples, vectorized=False):
 		if isinstance(num_samples, float):
 			if 0. <= num_samples <= 1.:
 				num_samples = int(num_samples * self.n_blocks)
@@ -259,22 +558,34 @@ class RegularGridDivider:
 				error = 'Expecting `num_samples` to be an integer or a (0, 1)-float.'
 				raise ValueError(error)
 		indices = self._random_block_indices(num_samples)
-		for (i, j) in indices:
-			self.blocks[i][j].apply(func)
+		if self._check_vectorized(vectorized):
+			rows, cols = np.reshape(indices, (-1, 2)).T
+			self.blocks[rows, cols] = func(self.blocks[rows, cols])
+		else:
+			for (i, j) in indices:
+				self._block(i, j).apply(func)
 
 	def apply_to_random(self, func):
 		i, j = self._random_block_index()
-		self.blocks[i][j].apply(func)
+		self._block(i, j).apply(func)
 
-	def apply_to_selected(self, indices, func):
+	def apply_to_selected(self, indices, func, vectorized=False):
 		assert isinstance(indices, list)
-		for (i, j) in indices:
-			self.blocks[i][j].apply(func)
+		if self._check_vectorized(vectorized):
+			rows, cols = np.reshape(indices, (-1, 2)).T
+			self.blocks[rows, cols] = func(self.blocks[rows, cols])
+		else:
+			for (i, j) in indices:
+				self._block(i, j).apply(func)
 
 	def paint_all(self, col_func):
-		for block in self:
-			col = col_func()
-			block.paint(col)
+		if self.strided:
+			cols = check_colors([col_func() for _ in range(self.n_blocks)], to_numpy=True)
+			self.blocks[...] = cols.reshape(self.n_row_blocks, self.n_col_blocks, 1, 1, 3)
+		else:
+			for block in self:
+				col = col_func()
+				block.paint(col)
 
 	def paint_random_sample(self, col_func, num_samples):
 		if isinstance(num_samples, float):
@@ -284,33 +595,384 @@ class RegularGridDivider:
 				error = 'Expecting `num_samples` to be an integer or a (0, 1)-float.'
 				raise ValueError(error)
 		indices = self._random_block_indices(num_samples)
-		for (i, j) in indices:
-			col = col_func()
-			self.blocks[i][j].paint(col)
+		self.paint_selected(indices, col_func)
 
 	def paint_random(self, col_func):
 		i, j = self._random_block_index()
 		col = col_func()
-		self.blocks[i][j].paint(col)
+		self._block(i, j).paint(col)
 
 	def paint_selected(self, indices, col_func):
 		assert isinstance(indices, list)
-		for (i, j) in indices:
-			col = col_func()
-			self.blocks[i][j].paint(col)
+		if self.strided:
+			rows, cols = np.reshape(indices, (-1, 2)).T
+			paint_cols = check_colors([col_func() for _ in range(len(rows))], to_numpy=True)
+			self.blocks[rows, cols] = paint_cols[:, np.newaxis, np.newaxis, :]
+		else:
+			for (i, j) in indices:
+				col = col_func()
+				self._block(i, j).paint(col)
+
+	def to_label_image(self):
+		labels = np.arange(self.n_blocks, dtype=np.int32).reshape(self.n_row_blocks, self.n_col_blocks)
+		return np.repeat(np.repeat(labels, self.block_size[0], axis=0), self.block_size[1], axis=1)
+
+	# renders blocks painted with a (n_blocks, 3) palette in one pass, blocks are left untouched
+	def render_palette(self, palette):
+		palette = _check_palette(palette, self.n_blocks).reshape(self.n_row_blocks, self.n_col_blocks, 3)
+		return np.repeat(np.repeat(palette, self.block_size[0], axis=0), self.block_size[1], axis=1)
 
 	def stitch(self):
-		canvas = np.zeros_like(self.img)
+		if self.strided:
+			return self.img
 		sr, sc = self.block_size
+		if self.lazy:
+			canvas = deepcopy(self.img)
+			for ind, block in self.blocks.modified.items():
+				i, j = ind // self.n_col_blocks, ind % self.n_col_blocks
+				canvas[i * sr: (i + 1) * sr, j * sc: (j + 1) * sc] = block.img
+			return canvas
+		canvas = np.zeros_like(self.img)
 		for i in range(self.n_row_blocks):
 			for j in range(self.n_col_blocks):
 				canvas[i * sr: (i + 1) * sr, j * sc: (j + 1) * sc] = self.blocks[i][j].img
 		return canvas
 
 
+# src can be an array (np.memmap included), a .npy file or a raw file (needs shape)
+def _open_image(src, shape=None, dtype=np.uint8):
+	if not isinstance(src, str):
+		return src
+	elif not os.path.isfile(src):
+		raise IOError('Argument {} does not point towards an existing file.'.format(src))
+	elif src.endswith('.npy'):
+		return np.load(src, mmap_mode='r')
+	elif shape is None:
+		raise ValueError('Need to specify `shape` to memory-map a raw image file.')
+	return np.memmap(src, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+def _remove_file(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+
+# out can be an array or a .npy / raw file path (created), a temporary .npy file otherwise
+# the temporary file is unlinked as soon as it is mapped, its space is released when the mapping is
+# closed (once the divider and the arrays returned by stitch() are gone)
+# where mapped files cannot be removed (windows), it is removed when the mapping is garbage collected
+def _open_output(out, shape, dtype):
+	if out is None:
+		fd, path = tempfile.mkstemp(suffix='.npy')
+		os.close(fd)
+		out = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+		try:
+			os.remove(path)
+		except OSError:
+			weakref.finalize(out, _remove_file, path)
+		return out
+	if not isinstance(out, str):
+		if out.shape != shape:
+			raise IndexError('Output should have the same shape as the image.')
+		return out
+	elif out.endswith('.npy'):
+		return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+	return np.memmap(out, dtype=dtype, mode='w+', shape=shape)
+
+
+# divides an image that does not fit in memory into tiles streamed from a memory-mapped file
+# only one tile (plus its halo) is loaded at a time and results are written into `out`
+# halo pixels are read around each tile so that neighbourhood ops (e.g. blur) stay seamless,
+# they are cropped before writing back, so functions must preserve tile shapes
+# tiles on the bottom / right borders may be smaller than tile_size
+class TiledDivider:
+
+	def __init__(self, src, tile_size, halo=0, out=None, shape=None, dtype=np.uint8):
+		self.img = _open_image(src, shape, dtype)
+		self.tile_size = tile_size
+		self.halo = halo
+		self._check_tile_size()
+		self.out = _open_output(out, self.img.shape, self.img.dtype)
+		self._processed = np.zeros((self.n_row_tiles, self.n_col_tiles), dtype=bool)
+		self._curr = 0
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self._curr > self.n_tiles - 1:
+			self._curr = 0
+			raise StopIteration
+		else:
+			i, j = self._curr // self.n_col_tiles, self._curr % self.n_col_tiles
+			self._curr += 1
+			return self._get_tile(i, j)
+
+	def __getitem__(self, iter_):
+		i, j = iter_
+		if i > self.n_row_tiles - 1:
+			raise IndexError('Exceeded actual amount of tiles per row.')
+		elif j > self.n_col_tiles - 1:
+			raise IndexError('Exceeded actual amount of tiles per column.')
+		return self._get_tile(i, j)
+
+	def __len__(self):
+		return self.n_tiles
+
+	@property
+	def n_row_tiles(self):
+		return -(-self.img.shape[0] // self.tile_size[0])
+
+	@property
+	def n_col_tiles(self):
+		return -(-self.img.shape[1] // self.tile_size[1])
+
+	@property
+	def n_tiles(self):
+		return self.n_row_tiles * self.n_col_tiles
+
+	def _check_tile_size(self):
+		if not is_iterable(self.tile_size):
+			raise TypeError('tile size should be an iterable.')
+		elif len(self.tile_size) != 2:
+			raise IndexError('tile size should have a length of 2.')
+		elif self.halo < 0:
+			raise ValueError('halo should be a positive integer.')
+
+	# core slices of the tile, and slices of the tile with its halo
+	def _tile_slices(self, i, j):
+		h, w = self.img.shape[:2]
+		sr, sc = self.tile_size
+		r0, r1, c0, c1 = i * sr, min(h, (i + 1) * sr), j * sc, min(w, (j + 1) * sc)
+		hr0, hr1 = max(0, r0 - self.halo), min(h, r1 + self.halo)
+		hc0, hc1 = max(0, c0 - self.halo), min(w, c1 + self.halo)
+		core = (slice(r0, r1), slice(c0, c1))
+		halo = (slice(hr0, hr1), slice(hc0, hc1))
+		crop = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+		return core, halo, crop
+
+	# tiles are loaded in memory with their halo
+	# the divider owns them : applying a function to (or painting) a tile writes its core into `out`,
+	# so that tiles obtained by iteration or indexing behave as those of other dividers
+	def _get_tile(self, i, j):
+		core, halo, _ = self._tile_slices(i, j)
+		coords = np.array([[core[0].start, core[1].start], [core[0].stop - 1, core[1].stop - 1]])
+		tile = Block(np.array(self.img[halo]), coords=coords)
+		tile._owner = (self, (i, j))
+		return tile
+
+	def _pin(self, ij, tile):
+		self._write_tile(*ij, tile)
+
+	def _write_tile(self, i, j, tile):
+		core, _, crop = self._tile_slices(i, j)
+		self.out[core] = tile.img[crop]
+		self._processed[i, j] = True
+
+	def apply_to_all(self, func):
+		for i in range(self.n_row_tiles):
+			for j in range(self.n_col_tiles):
+				self.apply_to_selected([(i, j)], func)
+
+	def apply_to_selected(self, indices, func):
+		assert isinstance(indices, list)
+		for (i, j) in indices:
+			self._get_tile(i, j).apply(func)
+
+	def paint_all(self, col_func):
+		for i in range(self.n_row_tiles):
+			for j in range(self.n_col_tiles):
+				core, _, _ = self._tile_slices(i, j)
+				col = check_color(col_func(), to_numpy=True)
+				self.out[core] = col
+				self._processed[i, j] = True
+
+	# tiles that were never processed are copied as is, the output is flushed to disk
+	def stitch(self):
+		for i, j in zip(*np.nonzero(~self._processed)):
+			core, _, _ = self._tile_slices(i, j)
+			self.out[core] = self.img[core]
+			self._processed[i, j] = True
+		if isinstance(self.out, np.memmap):
+			self.out.flush()
+		return self.out
+
+
+# adaptive divider recursively splitting blocks whose color variance (averaged over channels)
+# exceeds `threshold`, blocks are never split below `min_size` nor deeper than `max_depth`
+# statistics are read in O(1) from summed-area tables of the values and squared values,
+# built at the resolution of min_size tiles so that they stay small for very large images
+# lazy dividers only build a block when it is accessed (see LazyRegions)
+class QuadtreeDivider:
+
+	def __init__(self, img, threshold, min_size=(4, 4), max_depth=None, lazy=False, cache_size=None):
+		self.img = img
+		self.threshold = threshold
+		self.min_size = min_size
+		self.max_depth = max_depth
+		self._check_min_size()
+		self.coords = self._split()
+		self.lazy = lazy
+		if lazy:
+			self.blocks = LazyRegions(self._get_block, self.n_blocks, cache_size)
+		else:
+			self.blocks = [self._get_block(i) for i in range(self.n_blocks)]
+		self._curr = 0
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self._curr > self.n_blocks - 1:
+			self._curr = 0
+			raise StopIteration
+		else:
+			self._curr += 1
+			return self.blocks[self._curr - 1]
+
+	def __getitem__(self, i):
+		if i > self.n_blocks - 1:
+			raise IndexError('Exceeded actual amount of blocks.')
+		return self.blocks[i]
+
+	def __len__(self):
+		return self.n_blocks
+
+	@property
+	def n_blocks(self):
+		return len(self.coords)
+
+	def _check_min_size(self):
+		if not is_iterable(self.min_size):
+			raise TypeError('min size should be an iterable.')
+		elif len(self.min_size) != 2:
+			raise IndexError('min size should have a length of 2.')
+
+	def _tile_bounds(self):
+		h, w = self.img.shape[:2]
+		row_bounds = np.append(np.arange(0, h, self.min_size[0]), h)
+		col_bounds = np.append(np.arange(0, w, self.min_size[1]), w)
+		return row_bounds, col_bounds
+
+	# (n_row_tiles + 1, n_col_tiles + 1, 4) table of channel sums and squared sums
+	# tiles are summed by strips in integers, using uint32 whenever a tile cannot overflow it
+	def _summed_area_tables(self, row_bounds, col_bounds):
+		n_rows, n_cols = len(row_bounds) - 1, len(col_bounds) - 1
+		acc = np.uint32 if np.prod(self.min_size) * 3 * 255 ** 2 < 2 ** 32 else np.uint64
+		tiles = np.zeros((n_rows, n_cols, 4))
+		step = max(1, DEF_CHUNK_SIZE // (self.img.shape[1] * self.min_size[0]))
+		for start in range(0, n_rows, step):
+			stop = min(n_rows, start + step)
+			strip = self.img[row_bounds[start]: row_bounds[stop]]
+			local_bounds = row_bounds[start: stop] - row_bounds[start]
+			squares = np.sum(strip.astype(acc) ** 2, axis=2, dtype=acc)
+			sums = np.add.reduceat(strip, local_bounds, axis=0, dtype=acc)
+			squares = np.add.reduceat(squares, local_bounds, axis=0)
+			tiles[start: stop, :, :3] = np.add.reduceat(sums, col_bounds[:-1], axis=1)
+			tiles[start: stop, :, 3] = np.add.reduceat(squares, col_bounds[:-1], axis=1)
+		tables = np.zeros((n_rows + 1, n_cols + 1, 4))
+		np.cumsum(np.cumsum(tiles, axis=0), axis=1, out=tables[1:, 1:])
+		return tables
+
+	# nodes are (row_start, col_start, row_end, col_end) in tile units, processed level by level
+	def _split(self):
+		row_bounds, col_bounds = self._tile_bounds()
+		tables = self._summed_area_tables(row_bounds, col_bounds)
+		nodes = np.array([[0, 0, len(row_bounds) - 1, len(col_bounds) - 1]])
+		leaves = []
+		depth = 0
+		while len(nodes):
+			r0, c0, r1, c1 = nodes.T
+			sums = tables[r1, c1] - tables[r0, c1] - tables[r1, c0] + tables[r0, c0]
+			area = ((row_bounds[r1] - row_bounds[r0]) * (col_bounds[c1] - col_bounds[c0]))[:, np.newaxis]
+			means = sums[:, :3] / area
+			var = (sums[:, 3] / area[:, 0] - np.sum(means * means, axis=1)) / 3.
+			splittable = (r1 - r0 > 1) | (c1 - c0 > 1)
+			if self.max_depth is not None and depth >= self.max_depth:
+				splittable[:] = False
+			split = splittable & (var > self.threshold)
+			leaves.append(nodes[~split])
+			nodes = self._children(nodes[split])
+			depth += 1
+		leaves = np.concatenate(leaves)
+		return np.stack([row_bounds[leaves[:, 0]], col_bounds[leaves[:, 1]],
+						 row_bounds[leaves[:, 2]], col_bounds[leaves[:, 3]]], axis=1)
+
+	# splits in four, or in two along the only dimension spanning several tiles
+	def _children(self, nodes):
+		r0, c0, r1, c1 = nodes.T
+		rm = np.where(r1 - r0 > 1, (r0 + r1) // 2, r1)
+		cm = np.where(c1 - c0 > 1, (c0 + c1) // 2, c1)
+		children = np.concatenate([np.stack([r0, c0, rm, cm], axis=1),
+								   np.stack([r0, cm, rm, c1], axis=1),
+								   np.stack([rm, c0, r1, cm], axis=1),
+								   np.stack([rm, cm, r1, c1], axis=1)])
+		return children[(children[:, 2] > children[:, 0]) & (children[:, 3] > children[:, 1])]
+
+	def _get_block(self, i):
+		r0, c0, r1, c1 = self.coords[i]
+		return Block(self.img[r0: r1, c0: c1], coords=np.array([[r0, c0], [r1 - 1, c1 - 1]]))
+
+	def _regions(self):
+		return [(block, (slice(r0, r1), slice(c0, c1))) for block, (r0, c0, r1, c1) in zip(self.blocks, self.coords)]
+
+	def apply_to_all(self, func, workers=None, backend='thread'):
+		if _is_parallel(workers):
+			_apply_parallel(self._regions(), func, self.img, workers, backend)
+		else:
+			for block in self:
+				block.apply(func)
+
+	def paint_all(self, col_func):
+		for block in self:
+			col = col_func()
+			block.paint(col)
+
+	# (n_row_tiles, n_col_tiles) block index of each min_size tile, every block covering whole tiles
+	# the tiles of all blocks are enumerated at once, block by block in row-major order
+	def _tile_labels(self):
+		row_bounds, col_bounds = self._tile_bounds()
+		tiles = -(-self.coords // np.tile(self.min_size, 2))
+		heights, widths = tiles[:, 2] - tiles[:, 0], tiles[:, 3] - tiles[:, 1]
+		counts = heights * widths
+		labels = np.repeat(np.arange(self.n_blocks, dtype=np.int32), counts)
+		offsets = np.arange(len(labels)) - np.repeat(np.cumsum(counts) - counts, counts)
+		rows = tiles[labels, 0] + offsets // widths[labels]
+		cols = tiles[labels, 1] + offsets % widths[labels]
+		tile_labels = np.empty((len(row_bounds) - 1, len(col_bounds) - 1), dtype=np.int32)
+		tile_labels[rows, cols] = labels
+		return tile_labels
+
+	def _expand_tiles(self, tile_vals):
+		row_bounds, col_bounds = self._tile_bounds()
+		return np.repeat(np.repeat(tile_vals, np.diff(row_bounds), axis=0), np.diff(col_bounds), axis=1)
+
+	def to_label_image(self):
+		return self._expand_tiles(self._tile_labels())
+
+	# renders blocks painted with a (n_blocks, 3) palette in one pass, blocks are left untouched
+	def render_palette(self, palette):
+		return self._expand_tiles(_check_palette(palette, self.n_blocks)[self._tile_labels()])
+
+	def stitch(self):
+		if self.lazy:
+			canvas = deepcopy(self.img)
+			for i, block in self.blocks.modified.items():
+				r0, c0, r1, c1 = self.coords[i]
+				canvas[r0: r1, c0: c1] = block.img
+			return canvas
+		canvas = np.zeros_like(self.img)
+		for block, (r0, c0, r1, c1) in zip(self.blocks, self.coords):
+			canvas[r0: r1, c0: c1] = block.img
+		return canvas
+
+
 class CircularDivider:
 
-	def __init__(self, img, rads, center=None):
+	# lazy dividers only gather the pixels of a cell when it is accessed (see LazyRegions)
+	def __init__(self, img, rads, center=None, lazy=False, cache_size=None):
 		self.img = img
 		self.rads = rads
 		if center is None:
@@ -318,8 +980,13 @@ class CircularDivider:
 		else:
 			self.center = np.array(center)
 		self._remove_duplicates(sort=True)
-		self._dist_map = self._map_dist_to_center() 
-		self.cells = self._divide_into_cells()
+		self._labels = self._label_rings()
+		self._order, self._offsets = _group_by_label(self._labels, self.n_cells + 1)
+		self.lazy = lazy
+		if lazy:
+			self.cells = LazyRegions(self._get_cell, self.n_cells, cache_size)
+		else:
+			self.cells = self._divide_into_cells()
 		self._curr = 0
 
 	def __iter__(self):
@@ -359,11 +1026,21 @@ class CircularDivider:
 		h, w = self.img.shape[:2]
 		return np.array([int(h // 2), int(w // 2)])
 
-	#TODO: can make faster by large margin
-	def _map_dist_to_center(self):
+	# squared distances skip the sqrt, radiuses are squared instead
+	def _map_dist_to_center(self, squared=False):
 		h, w = self.img.shape[:2]
-		ijmap = np.array([[[i, j] for j in range(w)] for i in range(h)])
-		return np.linalg.norm(ijmap - self.center, axis=-1)
+		di = np.arange(h, dtype=np.float32)[:, np.newaxis] - np.float32(self.center[0])
+		dj = np.arange(w, dtype=np.float32)[np.newaxis, :] - np.float32(self.center[1])
+		dist = di * di + dj * dj
+		if squared:
+			return dist
+		return np.sqrt(dist, out=dist)
+
+	# label i is ring i, pixels beyond the last ring get label n_cells (left untouched)
+	def _label_rings(self):
+		edges = np.append(self.rads, max(self._max_rad, self.rads[-1])).astype(np.float32)
+		dist = self._map_dist_to_center(squared=True)
+		return np.digitize(dist, edges * edges).astype(np.int32)
 
 	@property 
 	def _max_rad(self):
@@ -374,44 +1051,76 @@ class CircularDivider:
 					   w - 1 - self.center[1]])
 
 	def _get_cell(self, i):
-		nb = self.n_cells
-		if i == 0:
-			rad_low, rad_high = 0, self.rads[i]
-		elif i == nb - 1:
-			rad_low, rad_high = self.rads[i - 1], self._max_rad
-		else:
-			rad_low, rad_high = self.rads[i - 1], self.rads[i]
-		rows, cols = np.where((self._dist_map >= rad_low) & (self._dist_map < rad_high))
-		vals = np.array([self.img[r, c] for r, c in zip(rows, cols)])
-		return Cell(vals, rows, cols)
+		return _cell_from_flat(self.img, self._order[self._offsets[i]: self._offsets[i + 1]])
 
-	def apply_to_all(self, func):
-		for cell in self:
-			cell.apply(func)
+	def _regions(self):
+		return [(cell, (cell.rows, cell.cols)) for cell in self.cells]
+
+	def apply_to_all(self, func, workers=None, backend='thread'):
+		if _is_parallel(workers):
+			_apply_parallel(self._regions(), func, self.img, workers, backend)
+		else:
+			for cell in self:
+				cell.apply(func)
 
 	def paint_all(self, col_func):
 		for cell in self:
 			col = col_func()
 			cell.paint(col)
 
+	# pixels beyond the last ring are labelled -1
+	def to_label_image(self):
+		labels = self._labels.copy()
+		labels[labels == self.n_cells] = -1
+		return labels
+
+	# renders cells painted with a (n_cells, 3) palette in one pass, cells are left untouched
+	# pixels beyond the last ring keep their original value
+	def render_palette(self, palette):
+		palette = _check_palette(palette, self.n_cells)
+		canvas = deepcopy(self.img)
+		inside = self._labels < self.n_cells
+		canvas[inside] = palette[self._labels[inside]]
+		return canvas
+
 	def stitch(self):
 		canvas = deepcopy(self.img)
-		for cell in self:
+		cells = self.cells.modified.values() if self.lazy else self
+		for cell in cells:
 			canvas[cell.rows, cell.cols] = cell.vals
 		return canvas
 
 
 class ArbitraryDivider:
 
-    def __init__(self, img, cell_rows, cell_cols):
+    # cells are given either as lists of row / col arrays or as an int label image
+    # (one label per pixel, every label in [0, n_cells) describing one cell)
+    # lazy dividers only gather the pixels of a cell when it is accessed (see LazyRegions)
+    def __init__(self, img, cell_rows=None, cell_cols=None, labels=None, lazy=False, cache_size=None):
         self.img = img
-        self.cell_rows = cell_rows
-        self.cell_cols = cell_cols
-        self._check_non_overlapping()
-        self._check_complete()
-        self.cells = self._divide_into_cells()
+        if labels is not None:
+            self._set_labels(labels)
+        else:
+            self.cell_rows = cell_rows
+            self.cell_cols = cell_cols
+            self._labels = None
+            self._order = self._offsets = None
+            counts = self._pixel_counts()
+            self._check_non_overlapping(counts)
+            self._check_complete(counts)
+        self.lazy = lazy
+        if lazy:
+            self.cells = LazyRegions(self._get_cell, self.n_cells, cache_size)
+        else:
+            self.cells = self._divide_into_cells()
         self._curr = 0
 
+    @classmethod
+    def from_label_image(cls, img, labels, lazy=False, cache_size=None):
+        divider = cls.__new__(cls)
+        ArbitraryDivider.__init__(divider, img, labels=labels, lazy=lazy, cache_size=cache_size)
+        return divider
+
     def __iter__(self):
         return self
 
@@ -435,37 +1144,82 @@ class ArbitraryDivider:
     def n_cells(self):
         assert len(self.cell_rows) == len(self.cell_cols)
         return len(self.cell_rows)
-    
-    def _concat(self, cell_rows, cell_cols):
-        all_elems = []
-        for row_arr, col_arr in zip(cell_rows, cell_cols):
-            all_elems.extend(list(zip(row_arr, col_arr)))
-        return all_elems
-    
-    def _check_non_overlapping(self):
-        all_elems = self._concat(self.cell_rows, self.cell_cols)
-        if len(all_elems) != len(set(all_elems)):
-            n_overlap = len(all_elems) - len(set(all_elems))
+
+    # unused labels are squeezed out so that cells are never empty
+    def _set_labels(self, labels):
+        labels = np.asarray(labels)
+        if labels.shape != self.img.shape[:2]:
+            raise IndexError('Label image should have the same height and width as the image.')
+        elif labels.min() < 0:
+            raise ValueError('Negative labels detected ({}).'.format(np.count_nonzero(labels < 0)))
+        counts = np.bincount(np.ravel(labels))
+        if not counts.all():
+            labels = (np.cumsum(counts > 0) - 1)[labels]
+            counts = counts[counts > 0]
+        self._labels = labels.astype(np.int32, copy=False)
+        self._order, self._offsets = _group_by_label(self._labels, len(counts))
+        rows, cols = np.divmod(self._order, self.img.shape[1])
+        bounds = list(zip(self._offsets[:-1].tolist(), self._offsets[1:].tolist()))
+        self.cell_rows = [rows[start: stop] for start, stop in bounds]
+        self.cell_cols = [cols[start: stop] for start, stop in bounds]
+
+    def _flat_indices(self):
+        h, w = self.img.shape[:2]
+        rows = np.concatenate([np.ravel(row_arr) for row_arr in self.cell_rows]).astype(np.int64)
+        cols = np.concatenate([np.ravel(col_arr) for col_arr in self.cell_cols]).astype(np.int64)
+        if len(rows) != len(cols):
+            raise IndexError('Cells have mismatching row and column lengths.')
+        elif len(rows) and (rows.min() < 0 or rows.max() >= h or cols.min() < 0 or cols.max() >= w):
+            raise IndexError('Cell coordinates out of image bounds.')
+        return rows * w + cols
+
+    # number of cells covering each pixel
+    def _pixel_counts(self):
+        n_pixels = np.prod(self.img.shape[:2])
+        return np.bincount(self._flat_indices(), minlength=n_pixels)
+
+    def _check_non_overlapping(self, counts):
+        n_overlap = np.sum(counts) - np.count_nonzero(counts)
+        if n_overlap:
             raise ValueError('Overlapping elements detected ({}).'.format(n_overlap))
-    
-    def _check_complete(self):
-        all_elems = self._concat(self.cell_rows, self.cell_cols)
+
+    def _check_complete(self, counts):
         n_pixels = np.prod(self.img.shape[:2])
-        if len(all_elems) != n_pixels:
-            n_missing = n_pixels - len(all_elems)
+        if np.sum(counts) != n_pixels:
+            n_missing = n_pixels - np.sum(counts)
             raise ValueError('Missing elements detected ({}).'.format(n_missing))
 
+    def _label_image(self):
+        if self._labels is None:
+            sizes = [len(row_arr) for row_arr in self.cell_rows]
+            labels = np.empty(np.prod(self.img.shape[:2]), dtype=np.int32)
+            labels[self._flat_indices()] = np.repeat(np.arange(self.n_cells, dtype=np.int32), sizes)
+            self._labels = labels.reshape(self.img.shape[:2])
+        return self._labels
+
+    def to_label_image(self):
+        return self._label_image().copy()
+
+    # renders cells painted with a (n_cells, 3) palette in one pass, cells are left untouched
+    def render_palette(self, palette):
+        return _check_palette(palette, self.n_cells)[self._label_image()]
+
     def _divide_into_cells(self):
         return [self._get_cell(i) for i in range(self.n_cells)]
 
     def _get_cell(self, i):
-        rows, cols = self.cell_rows[i], self.cell_cols[i]
-        vals = np.array([self.img[r, c] for r, c in zip(rows, cols)])
-        return Cell(vals, rows, cols)
+        rows, cols = np.asarray(self.cell_rows[i]), np.asarray(self.cell_cols[i])
+        return Cell(self.img[rows, cols], rows, cols)
 
-    def apply_to_all(self, func):
-        for cell in self:
-            cell.apply(func)
+    def _regions(self):
+        return [(cell, (cell.rows, cell.cols)) for cell in self.cells]
+
+    def apply_to_all(self, func, workers=None, backend='thread'):
+        if _is_parallel(workers):
+            _apply_parallel(self._regions(), func, self.img, workers, backend)
+        else:
+            for cell in self:
+                cell.apply(func)
     
     def paint_all(self, col_func):
         for cell in self:
@@ -474,41 +1228,377 @@ class ArbitraryDivider:
 
     def stitch(self):
         canvas = deepcopy(self.img)
-        for cell in self:
+        cells = self.cells.modified.values() if self.lazy else self
+        for cell in cells:
             canvas[cell.rows, cell.cols] = cell.vals
         return canvas
 
 
 class VoronoiDivider(ArbitraryDivider):
 
-    def __init__(self, img, coords, k, ordered=True):
-        cell_rows, cell_cols = self._voronoi(img, coords, k, ordered)
-        super().__init__(img, cell_rows, cell_cols)
-    
-    def _grid_coords(self, grid_size):
-        return np.array(np.meshgrid(np.arange(grid_size[0]),
-                                    np.arange(grid_size[1]))).T.reshape(-1, 2)
-    
-    def _ordered_tuple(self, elems):
-        elems.sort()
-        return tuple(elems)
-
-    def _voronoi(self, img, coords, k, ordered):
-        h, w = img.shape[:2]
+    # backend is either 'neighbors' (exact, any k) or 'edt' (k = 1 only, exact
+    # distance transform on a seed raster, seeds must be integer pixel coordinates)
+    # 'auto' picks 'edt' for k = 1 with integer seeds inside the image, which is several times faster,
+    # 'neighbors' otherwise
+    # neighbours are queried by strips of about `chunk_size` pixels to bound memory
+    def __init__(self, img, coords, k, ordered=True, backend='auto', chunk_size=DEF_CHUNK_SIZE, n_jobs=None,
+                 lazy=False, cache_size=None):
         if isinstance(coords, list):
             coords = np.array(coords)
-        nbrs = NearestNeighbors(n_neighbors=k).fit(coords)
-        img_coords = self._grid_coords((h, w))
-        _, indices = nbrs.kneighbors(img_coords)
-        if ordered:
-            indices = [self._ordered_tuple(idxs) for idxs in indices]
+        self.coords = coords
+        self.k = k
+        if backend == 'auto':
+            on_grid = np.all(coords == np.round(coords)) and np.all(coords >= 0) and np.all(coords < img.shape[:2])
+            backend = 'edt' if k == 1 and on_grid else 'neighbors'
+        if backend == 'neighbors':
+            labels = self._voronoi(img.shape[:2], coords, k, ordered, chunk_size, n_jobs)
+        elif backend == 'edt':
+            if k != 1:
+                raise ValueError('The `edt` backend only supports k=1.')
+            labels = self._voronoi_edt(img.shape[:2], coords)
         else:
-            indices = [tuple(idxs) for idxs in indices]
-        cell_rows = defaultdict(list)
-        cell_cols = defaultdict(list)
-        for coords, idx in zip(img_coords, indices):
-            cell_rows[idx].append(coords[0])
-            cell_cols[idx].append(coords[1])
-        cell_rows = [cell_rows[idx] for idx in set(indices)]
-        cell_cols = [cell_cols[idx] for idx in set(indices)]
-        return cell_rows, cell_cols
+            raise ValueError("`backend` expected values are 'auto', 'neighbors' or 'edt'.")
+        super().__init__(img, labels=labels, lazy=lazy, cache_size=cache_size)
+
+    # Voronoi partition (k = 1) of seeds relaxed with lloyd_relaxation
+    @classmethod
+    def relaxed(cls, img, coords, n_iter, weights=None, tol=0.5, lazy=False, cache_size=None):
+        coords, labels = lloyd_relaxation(img.shape[:2], coords, n_iter, weights, tol)
+        divider = cls.from_label_image(img, labels, lazy=lazy, cache_size=cache_size)
+        divider.coords = coords
+        divider.k = 1
+        return divider
+
+    def _strip_coords(self, row_start, row_end, w):
+        rows = np.repeat(np.arange(row_start, row_end), w)
+        cols = np.tile(np.arange(w), row_end - row_start)
+        return np.stack([rows, cols], axis=1)
+
+    # k-order cell ids are given by first appearance of each neighbour tuple, tuples within a strip in sorted order
+    # the k seed indices of a pixel are packed into one int64 key (base n_seeds digits) so that tuples are
+    # told apart with a 1-D np.unique, which sorts keys as tuples are sorted lexicographically
+    # n_jobs is passed to cKDTree.query as workers, all cores are used by default
+    def _voronoi(self, shape, coords, k, ordered, chunk_size, n_jobs=None):
+        h, w = shape
+        tree = cKDTree(coords)
+        workers = -1 if n_jobs is None else n_jobs
+        n_seeds = len(coords)
+        packed = k * math.log2(max(n_seeds, 2)) < 63
+        if packed:
+            digits = n_seeds ** np.arange(k - 1, -1, -1, dtype=np.int64)
+        labels = np.empty((h, w), dtype=np.int32)
+        cell_ids = {}
+        n_rows = max(1, chunk_size // w)
+        for row_start in range(0, h, n_rows):
+            row_end = min(h, row_start + n_rows)
+            _, indices = tree.query(self._strip_coords(row_start, row_end, w), k=k, workers=workers)
+            if k == 1:
+                labels[row_start: row_end] = indices.reshape(-1, w)
+                continue
+            if ordered:
+                indices.sort(axis=1)
+            if packed:
+                uniq, inverse = np.unique(indices.dot(digits), return_inverse=True)
+                uniq = uniq.tolist()
+            else:
+                uniq, inverse = np.unique(indices, axis=0, return_inverse=True)
+                uniq = map(tuple, uniq.tolist())
+            ids = np.array([cell_ids.setdefault(key, len(cell_ids)) for key in uniq], dtype=np.int32)
+            labels[row_start: row_end] = ids[np.ravel(inverse)].reshape(-1, w)
+        return labels
+
+    def _voronoi_edt(self, shape, coords):
+        if np.any(coords != np.round(coords)):
+            raise ValueError('The `edt` backend expects integer seed coordinates.')
+        coords = coords.astype(np.int64)
+        if np.any(coords < 0) or np.any(coords >= np.array(shape)):
+            raise IndexError('Seed coordinates out of image bounds.')
+        seeds = np.full(shape, -1, dtype=np.int32)
+        seeds[coords[:, 0], coords[:, 1]] = np.arange(len(coords))
+        _, (rows, cols) = distance_transform_edt(seeds < 0, return_indices=True)
+        return seeds[rows, cols]
+
+
+# nearest and second nearest seeds (and distances) of each pixel in flat_idx, queried by chunks
+def _two_nearest_seeds(tree, flat_idx, w, chunk_size=DEF_CHUNK_SIZE):
+	indices = np.empty(len(flat_idx), dtype=np.int32)
+	dists = np.empty((len(flat_idx), 2))
+	for start in range(0, len(flat_idx), chunk_size):
+		rows, cols = np.divmod(flat_idx[start: start + chunk_size], w)
+		chunk_dists, chunk_indices = tree.query(np.stack([rows, cols], axis=1), k=2)
+		indices[start: start + chunk_size] = chunk_indices[:, 0]
+		dists[start: start + chunk_size] = chunk_dists
+	return indices, dists[:, 0], dists[:, 1]
+
+
+# Lloyd relaxation of Voronoi seeds (k = 1) : seeds move to the centroid of their cell, weighted
+# by `weights` if given (e.g. darkness for stippling), then pixels are relabelled
+# the label raster is kept between iterations, along with an upper bound on the distance of each
+# pixel to its seed and a lower bound on the distance to any other seed (Hamerly's bounds) :
+# only pixels whose bounds cross after seeds moved are queried again
+# seeds moving less than `tol` pixels stay in place, relaxation stops once no seed moves
+# returns the relaxed (float) seed coordinates and the final label raster
+def lloyd_relaxation(shape, coords, n_iter, weights=None, tol=0.5, chunk_size=DEF_CHUNK_SIZE):
+	h, w = shape[:2]
+	coords = np.array(coords, dtype=np.float64)
+	n_seeds = len(coords)
+	rows, cols = np.divmod(np.arange(h * w), w)
+	if weights is None:
+		weights = np.ones(h * w)
+	else:
+		weights = np.ravel(weights).astype(np.float64)
+	weighted_rows, weighted_cols = weights * rows, weights * cols
+	labels, upper, lower = _two_nearest_seeds(cKDTree(coords), np.arange(h * w), w, chunk_size)
+	for _ in range(n_iter):
+		mass = np.bincount(labels, weights=weights, minlength=n_seeds)
+		filled = mass > 0
+		centroids = coords.copy()
+		centroids[filled, 0] = np.bincount(labels, weights=weighted_rows, minlength=n_seeds)[filled] / mass[filled]
+		centroids[filled, 1] = np.bincount(labels, weights=weighted_cols, minlength=n_seeds)[filled] / mass[filled]
+		shifts = np.sqrt(np.sum((centroids - coords) ** 2, axis=1))
+		moved = shifts >= tol
+		if not np.any(moved):
+			break
+		shifts[~moved] = 0.
+		coords[moved] = centroids[moved]
+		upper += shifts[labels]
+		lower -= shifts.max()
+		# bounds are tightened with the exact distance to the current seed before querying
+		flat_idx = np.flatnonzero(upper > lower)
+		owners = coords[labels[flat_idx]]
+		upper[flat_idx] = np.sqrt((rows[flat_idx] - owners[:, 0]) ** 2 + (cols[flat_idx] - owners[:, 1]) ** 2)
+		flat_idx = flat_idx[upper[flat_idx] > lower[flat_idx]]
+		labels[flat_idx], upper[flat_idx], lower[flat_idx] = _two_nearest_seeds(cKDTree(coords), flat_idx, w, chunk_size)
+	return coords, labels.reshape(h, w)
+
+
+# cells are the connected regions of equal color (4 or 8-connectivity)
+# quantize=q first reduces each channel to q levels so that close colors merge
+# components are found on the graph linking equal neighbouring pixels, in linear time
+class ConnectedComponentDivider(ArbitraryDivider):
+
+	def __init__(self, img, quantize=None, connectivity=4, lazy=False, cache_size=None):
+		self.quantize = quantize
+		self.connectivity = connectivity
+		labels = self._components(img, quantize, connectivity)
+		super().__init__(img, labels=labels, lazy=lazy, cache_size=cache_size)
+
+	def _color_keys(self, img, quantize):
+		channels = img.astype(np.int32)
+		if quantize is not None:
+			channels = channels * quantize // 256
+		return (channels[..., 0] << 16) | (channels[..., 1] << 8) | channels[..., 2]
+
+	def _components(self, img, quantize, connectivity):
+		if connectivity == 4:
+			shifts = [(0, 1), (1, 0)]
+		elif connectivity == 8:
+			shifts = [(0, 1), (1, 0), (1, 1), (1, -1)]
+		else:
+			raise ValueError('`connectivity` expected values are 4 or 8.')
+		h, w = img.shape[:2]
+		keys = self._color_keys(img, quantize)
+		idx = np.arange(h * w).reshape(h, w)
+		srcs, dsts = [], []
+		for dr, dc in shifts:
+			src_sl = (slice(0, h - dr), slice(max(0, -dc), w - max(0, dc)))
+			dst_sl = (slice(dr, h), slice(max(0, dc), w - max(0, -dc)))
+			same = keys[src_sl] == keys[dst_sl]
+			srcs.append(idx[src_sl][same])
+			dsts.append(idx[dst_sl][same])
+		srcs, dsts = np.concatenate(srcs), np.concatenate(dsts)
+		graph = coo_matrix((np.ones(len(srcs), dtype=np.int8), (srcs, dsts)), shape=(h * w, h * w))
+		_, labels = connected_components(graph, directed=False)
+		return labels.reshape(h, w)
+
+
+# SLIC superpixels (Achanta et al., 2012) : about n_segments compact cells of similar color
+# each center only searches a window of twice the grid step around it, in CIELAB space,
+# compactness weighs spatial against color distance
+class SLICDivider(ArbitraryDivider):
+
+	def __init__(self, img, n_segments, compactness=10., n_iter=10, lazy=False, cache_size=None):
+		self.n_segments = n_segments
+		self.compactness = compactness
+		self.n_iter = n_iter
+		labels = self._slic(img, n_segments, compactness, n_iter)
+		super().__init__(img, labels=labels, lazy=lazy, cache_size=cache_size)
+
+	def _initial_centers(self, shape, step):
+		rows = np.arange(step / 2., shape[0], step)
+		cols = np.arange(step / 2., shape[1], step)
+		centers = np.stack(np.meshgrid(rows, cols, indexing='ij'), axis=-1).reshape(-1, 2)
+		return centers
+
+	def _slic(self, img, n_segments, compactness, n_iter):
+		h, w = img.shape[:2]
+		step = max(1., np.sqrt(h * w / float(n_segments)))
+		lab = rgb_to_lab(img)
+		positions = self._initial_centers((h, w), step)
+		colors = lab[positions[:, 0].astype(int), positions[:, 1].astype(int)]
+		spatial_weight = (compactness / step) ** 2
+		radius = int(np.ceil(step))
+		labels = np.full((h, w), -1, dtype=np.int32)
+		dist = np.empty((h, w), dtype=np.float32)
+		for _ in range(n_iter):
+			dist.fill(np.inf)
+			for k, ((cr, cc), color) in enumerate(zip(positions, colors)):
+				r0, r1 = max(0, int(cr) - radius), min(h, int(cr) + radius + 1)
+				c0, c1 = max(0, int(cc) - radius), min(w, int(cc) + radius + 1)
+				rr = spatial_weight * (np.arange(r0, r1, dtype=np.float32) - cr) ** 2
+				cc_ = spatial_weight * (np.arange(c0, c1, dtype=np.float32) - cc) ** 2
+				diff = lab[r0: r1, c0: c1] - color
+				d = np.einsum('ijk,ijk->ij', diff, diff)
+				d += rr[:, np.newaxis]
+				d += cc_[np.newaxis, :]
+				closer = d < dist[r0: r1, c0: c1]
+				np.copyto(dist[r0: r1, c0: c1], d, where=closer)
+				labels[r0: r1, c0: c1][closer] = k
+			positions, colors = self._update_centers(lab, labels, positions, colors)
+		if np.any(labels < 0):
+			_, (rows, cols) = distance_transform_edt(labels < 0, return_indices=True)
+			labels = labels[rows, cols]
+		return labels
+
+	# centers move to the mean position and color of their cell, empty cells keep their center
+	def _update_centers(self, lab, labels, positions, colors):
+		flat = np.ravel(labels)
+		assigned = flat >= 0
+		flat = flat[assigned]
+		n_centers = len(positions)
+		counts = np.bincount(flat, minlength=n_centers)
+		rows, cols = np.divmod(np.flatnonzero(assigned), labels.shape[1])
+		feats = [rows, cols] + [lab[..., c].ravel()[assigned] for c in range(3)]
+		means = np.stack([np.bincount(flat, weights=f, minlength=n_centers) for f in feats], axis=1)
+		filled = counts > 0
+		means[filled] /= counts[filled, np.newaxis]
+		positions, colors = positions.copy(), colors.copy()
+		positions[filled] = means[filled, :2]
+		colors[filled] = means[filled, 2:].astype(np.float32)
+		return positions, colors
+
+
+# geometry of a partition (label image and pixel grouping) computed once for an image shape,
+# then applied to any image or (N, H, W, 3) batch of that shape with gathers and scatters only
+# label -1 marks pixels outside of every region (e.g. beyond the last ring of a CircularDivider)
+class PartitionPlan:
+
+	def __init__(self, labels, n_regions=None, order=None, offsets=None):
+		self.labels = np.asarray(labels, dtype=np.int32)
+		if n_regions is None:
+			n_regions = int(self.labels.max()) + 1
+		self.n_regions = n_regions
+		if order is None:
+			# outside pixels are grouped last
+			order, offsets = _group_by_label(np.where(self.labels < 0, n_regions, self.labels), n_regions + 1)
+		self._order = order
+		self._offsets = offsets
+
+	@property
+	def shape(self):
+		return self.labels.shape
+
+	# reuses the pixel grouping of dividers that already sorted their label image
+	@classmethod
+	def from_divider(cls, divider):
+		if isinstance(divider, CircularDivider):
+			return cls(divider.to_label_image(), divider.n_cells, divider._order, divider._offsets)
+		elif isinstance(divider, ArbitraryDivider) and divider._order is not None:
+			offsets = np.append(divider._offsets, divider._offsets[-1])
+			return cls(divider.to_label_image(), divider.n_cells, divider._order, offsets)
+		return cls(divider.to_label_image())
+
+	@classmethod
+	def circular(cls, shape, rads, center=None, cache_dir=None):
+		key = ('circular', tuple(shape[:2]), tuple(np.ravel(rads)), None if center is None else tuple(center))
+		build = lambda img: CircularDivider(img, rads, center, lazy=True)
+		return cls._cached(key, shape, build, cache_dir)
+
+	@classmethod
+	def voronoi(cls, shape, coords, k, ordered=True, backend='auto', cache_dir=None):
+		coords = np.asarray(coords)
+		key = ('voronoi', tuple(shape[:2]), coords.dtype.str, coords.tobytes(), k, ordered, backend)
+		build = lambda img: VoronoiDivider(img, coords, k, ordered, backend=backend, lazy=True)
+		return cls._cached(key, shape, build, cache_dir)
+
+	# plans are kept in a small in-memory LRU cache, and as .npz files in cache_dir if given
+	@classmethod
+	def _cached(cls, key, shape, build, cache_dir):
+		if key in _PLAN_CACHE:
+			_PLAN_CACHE.move_to_end(key)
+			return _PLAN_CACHE[key]
+		path = None
+		if cache_dir is not None:
+			path = os.path.join(cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+		if path is not None and os.path.isfile(path):
+			plan = cls.load(path)
+		else:
+			# dividers only need the image shape when built lazily
+			plan = cls.from_divider(build(np.broadcast_to(np.zeros(1, dtype=np.uint8), tuple(shape[:2]) + (3,))))
+			if path is not None:
+				plan.save(path)
+		_PLAN_CACHE[key] = plan
+		if len(_PLAN_CACHE) > DEF_PLAN_CACHE_SIZE:
+			_PLAN_CACHE.popitem(last=False)
+		return plan
+
+	def save(self, path):
+		np.savez(path, labels=self.labels, n_regions=self.n_regions, order=self._order, offsets=self._offsets)
+
+	@classmethod
+	def load(cls, path):
+		with np.load(path) as data:
+			return cls(data['labels'], int(data['n_regions']), data['order'], data['offsets'])
+
+	def _as_batch(self, imgs):
+		imgs = np.asarray(imgs)
+		if imgs.shape[-3:-1] != self.shape:
+			raise IndexError('Images should have the same height and width as the plan ({}).'.format(self.shape))
+		return imgs.reshape((-1, imgs.shape[-3] * imgs.shape[-2], imgs.shape[-1]))
+
+	# pixels sorted by region, region i spans offsets[i]: offsets[i + 1] along the pixel axis
+	def gather(self, imgs):
+		return np.take(self._as_batch(imgs), self._order, axis=1).reshape(np.shape(imgs)[:-3] + (-1, np.shape(imgs)[-1]))
+
+	@property
+	def offsets(self):
+		return self._offsets
+
+	# inverse of gather
+	def scatter(self, vals, out=None):
+		vals = np.asarray(vals)
+		if out is None:
+			out = np.empty(vals.shape[:-2] + self.shape + vals.shape[-1:], dtype=vals.dtype)
+		flat_out = out.reshape((-1, out.shape[-3] * out.shape[-2], out.shape[-1]))
+		flat_out[:, self._order] = vals.reshape((-1,) + vals.shape[-2:])
+		return out
+
+	# (n_regions, 3) mean colors, or (N, n_regions, 3) for a batch
+	def region_means(self, imgs):
+		flat = self._as_batch(imgs)
+		n_imgs, n_regions = len(flat), self.n_regions + 1
+		ids = (np.ravel(np.where(self.labels < 0, self.n_regions, self.labels))[np.newaxis, :]
+			   + n_regions * np.arange(n_imgs)[:, np.newaxis]).ravel()
+		counts = np.bincount(ids, minlength=n_imgs * n_regions).reshape(n_imgs, n_regions, 1)
+		sums = np.stack([np.bincount(ids, weights=flat[..., c].ravel(), minlength=n_imgs * n_regions)
+						 for c in range(flat.shape[-1])], axis=-1).reshape(n_imgs, n_regions, -1)
+		means = (sums / np.maximum(counts, 1))[:, :self.n_regions]
+		return means.reshape(np.shape(imgs)[:-3] + means.shape[1:])
+
+	# paints every region with its mean color, outside pixels keep their value
+	def mosaic(self, imgs):
+		imgs = np.asarray(imgs)
+		means = np.round(self.region_means(imgs)).astype(imgs.dtype)
+		flat_means = means.reshape((-1,) + means.shape[-2:])
+		out = flat_means[:, np.maximum(self.labels, 0)].reshape(imgs.shape)
+		if np.any(self.labels < 0):
+			outside = self.labels < 0
+			out[..., outside, :] = imgs[..., outside, :]
+		return out
+
+	# (n_regions, 3) palette rendered in one pass, outside pixels are left black
+	def render(self, palette):
+		palette = _check_palette(palette, self.n_regions)
+		out = palette[np.maximum(self.labels, 0)]
+		out[self.labels < 0] = 0
+		return out
@@ -0,0 +1,84 @@
+from imgproc import frame, morph
+from imgproc.tone import ToneCurve
+import numpy as np
+
+# ops taking an `out` argument, mapped to whether `out` can be the input image itself
+OUT_OPS = {
+	morph.modify_vividness: True,
+	morph.modify_brightness: True,
+	morph.modify_contrast: True,
+	morph.to_grayscale: True,
+	morph.to_negative: True,
+	morph.blur: True,
+	morph.box_blur: True,
+	morph.to_channel: True,
+	morph.map_pixval: True,
+	morph.pixelate: True,
+	morph.flip: False,
+	morph.translate: False,
+	frame.width_border: True,
+}
+OP_MODULES = [morph, frame]
+
+
+def _resolve_op(op):
+	if callable(op):
+		return op
+	for module in OP_MODULES:
+		if hasattr(module, op):
+			return getattr(module, op)
+	raise ValueError('{} is neither a callable nor an op of morph / frame.'.format(op))
+
+
+# sequence of ops applied lazily to an image : pipe(img) runs the whole chain
+# ops are functions (or their name in morph / frame) taking the image as first argument, or tone curves
+# ops of OUT_OPS write into (at most two) scratch buffers reused along the chain, in place when allowed
+# other ops (e.g. shape-changing ones) allocate their own result, which is then reused as a buffer
+# the input image is never modified
+# ops are kept by reference so that pipelines can be pickled and sent to worker processes
+class Pipeline:
+
+	# steps : sequence of (op, args, kwargs)
+	def __init__(self, steps=None):
+		self.steps = []
+		for op, args, kwargs in steps or []:
+			self.add(op, *args, **kwargs)
+
+	def __len__(self):
+		return len(self.steps)
+
+	def __repr__(self):
+		return 'Pipeline({})'.format(' -> '.join(getattr(op, '__name__', type(op).__name__) for op, _, _ in self.steps))
+
+	# returns the pipeline so that calls can be chained
+	def add(self, op, *args, **kwargs):
+		self.steps.append((_resolve_op(op), args, kwargs))
+		return self
+
+	def __call__(self, img, out=None):
+		curr, owned, spare = img, False, None
+		for i, (op, args, kwargs) in enumerate(self.steps):
+			# tone curves are applied in place as well
+			inplace = True if isinstance(op, ToneCurve) else OUT_OPS.get(op)
+			if inplace is not None:
+				last = i == len(self.steps) - 1
+				if last and out is not None and (inplace or not np.may_share_memory(out, curr)):
+					dst = out
+				elif owned and inplace:
+					dst = curr
+				elif spare is not None and spare.shape == curr.shape and spare.dtype == curr.dtype:
+					dst = spare
+				else:
+					dst = np.empty_like(curr)
+				res = op(curr, *args, out=dst, **kwargs)
+			else:
+				res = op(curr, *args, **kwargs)
+			if owned and not np.may_share_memory(res, curr):
+				spare = curr
+			curr, owned = res, not np.may_share_memory(res, img)
+		if out is not None and curr is not out:
+			out[:] = curr
+			return out
+		if not owned:
+			return curr.copy()
+		return curr
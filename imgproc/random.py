@@ -135,6 +135,11 @@ def random_color():
 	return np.random.randint(256, size=(3,)).astype(np.uint8)
 
 
+# (n_colors, 3) array of random colors, drawn at once
+def random_palette(n_colors):
+	return np.random.randint(256, size=(n_colors, 3)).astype(np.uint8)
+
+
 def random_grayscale():
 	return np.array([random.randint(0, 255)] * 3).astype(np.uint8)
 
@@ -1,47 +1,126 @@
-from collections import Counter
-from imgproc.utils import (check_img_arg, check_color, hex_to_rgb,
-						   img_to_2d_num_hash, img_to_luminance,
-						   num_hash_to_rgb, string_hash)
+from imgproc.utils import (check_img_arg, check_color, img_to_2d_num_hash, img_to_luminance,
+						   is_rgb_batch, pack_colors)
 import numpy as np
 from scipy.stats import entropy
 
+DEF_LUT_MIN_PIXELS = 2 ** 16
+
+LUMA_WEIGHTS = np.array([0.2126, 0.7152, 0.0722])
+
+
+# metrics also take (N, H, W, 3) stacks and then return one value (or color) per image
+# for single images, they take a ColorIndex as well, so that several metrics share one pass over the pixels
+
+
+# distinct colors of an image and their counts, from its packed 24 bit keys (see utils.pack_colors)
+# the inverse map (index of each pixel's color) is only built when asked for
+class ColorIndex:
+
+	def __init__(self, img):
+		check_img_arg(img)
+		self.shape = img.shape[:-1]
+		self.keys = np.ravel(pack_colors(img))
+		# sorting a copy of the keys is cheaper than a 2 ** 24 bincount, whose table dominates the cost
+		self.unique_keys, self.counts = np.unique(self.keys, return_counts=True)
+		self.colors = np.stack([self.unique_keys & 255, (self.unique_keys >> 8) & 255, self.unique_keys >> 16],
+							   axis=1).astype(np.uint8)
+		self._inverse = None
+
+	def __len__(self):
+		return len(self.counts)
+
+	@property
+	def n_pixels(self):
+		return len(self.keys)
+
+	# most frequent color (the smallest key among ties)
+	@property
+	def mode(self):
+		return self.colors[np.argmax(self.counts)]
+
+	# (H, W) indices into colors / counts
+	# on large images, a 2 ** 24 lookup table of keys (left uninitialized outside of the image's colors)
+	# is cheaper than a binary search per pixel
+	@property
+	def inverse(self):
+		if self._inverse is None:
+			if self.n_pixels >= DEF_LUT_MIN_PIXELS:
+				lut = np.empty(2 ** 24, dtype=np.int32)
+				lut[self.unique_keys] = np.arange(len(self))
+				inverse = lut[self.keys]
+			else:
+				inverse = np.searchsorted(self.unique_keys, self.keys)
+			self._inverse = inverse.reshape(self.shape)
+		return self._inverse
+
+
+def _color_index(img):
+	if isinstance(img, ColorIndex):
+		return img
+	return ColorIndex(img)
+
+
+# distinct colors of each image of a stack, through a single sort of the pixel hashes
+# returns the image index, hash and count of each (image, color) pair, by image then hash
+def _batch_color_counts(imgs):
+	n = imgs.shape[0]
+	hashes = np.sort(img_to_2d_num_hash(imgs).reshape(n, -1), axis=1)
+	starts = np.ones(hashes.shape, dtype=bool)
+	starts[:, 1:] = hashes[:, 1:] != hashes[:, :-1]
+	starts = np.flatnonzero(starts)
+	counts = np.diff(np.append(starts, hashes.size))
+	return starts // hashes.shape[1], np.ravel(hashes)[starts], counts
+
 
 #TODO: case where background color is not the mode pixel
 def background_color(img):
-    check_img_arg(img)
-    mode = Counter(np.ravel(img_to_2d_num_hash(img))).most_common(1)[0][0]
-    return np.array(num_hash_to_rgb(int(mode)))
+    if is_rgb_batch(img):
+        rows, hashes, counts = _batch_color_counts(img)
+        order = np.lexsort((-counts, rows))
+        modes = hashes[order][np.searchsorted(rows[order], np.arange(img.shape[0]))].astype(np.int64)
+        return np.stack([modes % 256, (modes // 256) % 256, modes // (256 ** 2)], axis=1)
+    return _color_index(img).mode.astype(np.int64)
 
 
 def color_ratios(img):
-	check_img_arg(img)
-	n = np.prod(img.shape[:2])
-	imh = img_to_2d_num_hash(img)
-	counts = Counter(np.ravel(imh))
-	color_ratios = [float(count) / n for _, count in counts.items()]
-	return color_ratios
+	if is_rgb_batch(img):
+		rows, _, counts = _batch_color_counts(img)
+		return np.split(counts / np.prod(img.shape[1:3]), np.flatnonzero(np.diff(rows)) + 1)
+	index = _color_index(img)
+	return (index.counts / index.n_pixels).tolist()
 
 
 def glob_entropy(img):
+	if is_rgb_batch(img):
+		rows, _, counts = _batch_color_counts(img)
+		ratios = counts / np.prod(img.shape[1:3])
+		return -np.bincount(rows, weights=ratios * np.log(ratios), minlength=img.shape[0])
 	return entropy(color_ratios(img))
 
 
 def num_colors(img):
-	check_img_arg(img)
-	return len(np.unique(np.ravel(img_to_2d_num_hash(img))))
+	if is_rgb_batch(img):
+		return np.bincount(_batch_color_counts(img)[0], minlength=img.shape[0])
+	return len(_color_index(img))
 
 
 def glob_luminance(img):
-	check_img_arg(img)
-	return np.mean(img_to_luminance(img))
+	if isinstance(img, ColorIndex):
+		return np.dot(img.colors.dot(LUMA_WEIGHTS), img.counts) / img.n_pixels
+	check_img_arg(img, allow_batch=True)
+	return np.mean(img_to_luminance(img), axis=(-2, -1))
 
 
 def dist_to_color(img, col):
-	check_img_arg(img)
 	col = check_color(col, to_numpy=True)
-	return np.linalg.norm(img - col[np.newaxis, np.newaxis, :])
+	if isinstance(img, ColorIndex):
+		return np.sqrt(np.dot(np.sum((img.colors - col) ** 2, axis=1), img.counts))
+	check_img_arg(img, allow_batch=True)
+	return np.sqrt(np.sum((img - col) ** 2, axis=(-3, -2, -1)))
 
 
 def dist_to_mode(img):
 	mode = background_color(img)
+	if is_rgb_batch(img):
+		return np.sqrt(np.sum((img - mode[:, np.newaxis, np.newaxis, :]) ** 2, axis=(1, 2, 3)))
 	return dist_to_color(img, mode)
@@ -0,0 +1,128 @@
+from imgproc.utils import make_output
+import numpy as np
+
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114])
+PIX_VALS = np.arange(256)
+
+
+# images are (H, W, 3) or (N, H, W, 3) stacks, or (H, W) grayscale images handled as one channel as PIL's 'L' mode
+def _check_channels(img):
+	if img.ndim == 2:
+		return
+	if img.ndim not in (3, 4) or img.shape[-1] != 3:
+		raise ValueError('Expected a (H, W) grayscale image, a (H, W, 3) image or a (N, H, W, 3) stack, got shape {}.'.format(img.shape))
+
+
+# (3, 256) per channel histograms of an image (or of a whole stack of images)
+# the histogram of a grayscale image is repeated for the three channels
+def channel_histograms(img):
+	_check_channels(img)
+	if img.ndim == 2:
+		return np.tile(np.bincount(np.ravel(img), minlength=256), (3, 1))
+	return np.stack([np.bincount(np.ravel(img[..., c]), minlength=256) for c in range(3)])
+
+
+# PIL's ImageEnhance blending of pixel values with degenerate, clipped then truncated
+def _blend_lut(degenerate, factor):
+	vals = np.float32(degenerate) + np.float32(factor) * (PIX_VALS.astype(np.float32) - np.float32(degenerate))
+	return np.clip(vals, 0, 255).astype(np.uint8)
+
+
+# composition of pointwise ops as one 256-entry uint8 LUT per channel
+# each op is composed after the previous ones and returns the curve, so that calls can be chained :
+# ToneCurve().brightness(1.2).gamma(0.8).posterize(4).apply(img)
+# histogram based ops (contrast, equalize, autocontrast) take the image the curve will be applied to,
+# its histograms are pushed through the current curve rather than recomputed on an intermediate image
+# curves apply to (N, H, W, 3) stacks as well, histogram based ops then use the histograms of the whole stack
+# (H, W) grayscale images take a single LUT, so the curve must treat the three channels alike
+class ToneCurve:
+
+	def __init__(self, lut=None):
+		if lut is None:
+			self.lut = np.tile(PIX_VALS.astype(np.uint8), (3, 1))
+		else:
+			self.lut = np.array(np.broadcast_to(lut, (3, 256)), dtype=np.uint8)
+
+	def __call__(self, img, out=None):
+		return self.apply(img, out)
+
+	# composes a (256,) or (3, 256) LUT after the current curve
+	def point(self, lut):
+		lut = np.broadcast_to(np.asarray(lut, dtype=np.uint8), (3, 256))
+		self.lut = np.take_along_axis(lut, self.lut.astype(np.intp), axis=1)
+		return self
+
+	# histograms of img once the current curve is applied
+	def histograms(self, img):
+		hists = channel_histograms(img)
+		return np.stack([np.bincount(self.lut[c], weights=hists[c], minlength=256) for c in range(3)]).astype(np.int64)
+
+	def brightness(self, factor):
+		return self.point(_blend_lut(0, factor))
+
+	# blends towards the mean gray level, as ImageEnhance.Contrast
+	# mean is the luma mean of the image, estimated from the histograms of img if not given
+	def contrast(self, factor, mean=None, img=None):
+		if mean is None:
+			if img is None:
+				raise ValueError('contrast needs either `mean` or `img`.')
+			hists = self.histograms(img)
+			mean = np.dot(LUMA_WEIGHTS, hists.dot(PIX_VALS) / hists.sum(axis=1))
+		return self.point(_blend_lut(int(mean + 0.5), factor))
+
+	def negative(self):
+		return self.point(255 - PIX_VALS)
+
+	def to_channel(self, channel='r'):
+		if channel.lower() not in ('r', 'g', 'b'):
+			err = 'channel argument must be one of `r`, `g` or `b`.'
+			raise ValueError(err)
+		lut = np.zeros((3, 256), dtype=np.uint8)
+		c = 'rgb'.index(channel.lower())
+		lut[c] = PIX_VALS
+		return self.point(lut)
+
+	def gamma(self, g):
+		return self.point(np.round(255. * (PIX_VALS / 255.) ** g))
+
+	# keeps the `bits` most significant bits of each channel, as ImageOps.posterize
+	def posterize(self, bits):
+		return self.point(PIX_VALS & ~(2 ** (8 - bits) - 1))
+
+	# per channel histogram equalization, as ImageOps.equalize
+	def equalize(self, img):
+		hists = self.histograms(img)
+		lut = np.tile(PIX_VALS, (3, 1))
+		for c in range(3):
+			nonzero = hists[c][hists[c] > 0]
+			if len(nonzero) <= 1:
+				continue
+			step = (nonzero.sum() - nonzero[-1]) // 255
+			if step:
+				cumul = np.concatenate([[0], np.cumsum(hists[c])[:-1]])
+				lut[c] = np.minimum((step // 2 + cumul) // step, 255)
+		return self.point(lut)
+
+	# per channel stretch of [min, max] to [0, 255], as ImageOps.autocontrast (cutoff = 0)
+	def autocontrast(self, img):
+		hists = self.histograms(img)
+		lut = np.tile(PIX_VALS, (3, 1))
+		for c in range(3):
+			lo, hi = np.flatnonzero(hists[c])[[0, -1]]
+			if hi > lo:
+				scale = 255. / (hi - lo)
+				lut[c] = np.clip(PIX_VALS * scale - lo * scale, 0, 255).astype(np.uint8)
+		return self.point(lut)
+
+	def apply(self, img, out=None):
+		_check_channels(img)
+		if img.ndim == 2:
+			if (self.lut != self.lut[0]).any():
+				raise ValueError('Grayscale images need a curve that is the same on all channels.')
+			out = make_output(img, out)
+			np.take(self.lut[0], img, out=out, mode='clip')
+			return out
+		out = make_output(img, out)
+		for c in range(3):
+			np.take(self.lut[c], img[..., c], out=out[..., c], mode='clip')
+		return out
@@ -82,6 +82,14 @@ def is_rgb_image(obj):
 	return False
 
 
+# stack of rgb images, as (N, H, W, 3)
+def is_rgb_batch(obj):
+	if hasattr(obj, 'dtype'):
+		if obj.ndim == 4 and obj.shape[3] == 3 and obj.dtype == 'uint8':
+			return True
+	return False
+
+
 def identify_dimensions(imgfile):
 	return imagesize.get(imgfile)
 
@@ -153,6 +161,15 @@ def check_color(col, to_numpy=False):
 		return np.array(col)
 
 
+# checks a sequence of colors at once, as a (n_colors, 3) array
+def check_colors(cols, to_numpy=False):
+	cols = np.asarray(cols)
+	if cols.ndim != 2 or cols.shape[1] != 3 or (cols.size and not has_values_in_range(cols)):
+		raise TypeError('Invalid colors argument.')
+	if to_numpy:
+		return cols
+
+
 def check_pixel(obj, to_numpy=False):
 	col = check_color(obj, to_numpy=to_numpy)
 	if to_numpy:
@@ -160,10 +177,12 @@ def check_pixel(obj, to_numpy=False):
 
 
 #TODO: add PIL format into account if needed
-def check_img_arg(img, allow_grayscale=False):	
+def check_img_arg(img, allow_grayscale=False, allow_batch=False):
 	if not is_rgb_image(img):
 		if allow_grayscale and is_grayscale_image(img):
 			return
+		if allow_batch and is_rgb_batch(img):
+			return
 		raise TypeError('Invalid image argument.')
 
 
@@ -230,6 +249,15 @@ def make_canvas(can_size, fill_value=255, mode='rgb'):
 		raise ValueError("`mode` expected values are 'rgb' or 'grayscale'.")
 
 
+# array receiving the result of an operation on img : `out` if given, else a new array
+def make_output(img, out=None):
+	if out is None:
+		return np.empty_like(img)
+	if out.shape != img.shape or out.dtype != img.dtype:
+		raise ValueError('`out` should have the shape and dtype of the image.')
+	return out
+
+
 def make_patch(patch_size, color):
 	tiling_size = tuple(patch_size) + (1,)
 	return np.tile(color, tiling_size)
@@ -258,16 +286,26 @@ def hex_chars():
 
 def string_hash(obj):
 	if is_rgb_image(obj):
-		return [rgb_to_hex(obj[i, j]) for i in range(obj.shape[0]) for j in range(obj.shape[1])]
+		return np.ravel(map_unique_colors(obj, rgb_to_hex)).tolist()
 	elif is_pixel(obj):
 		return rgb_to_hex(obj)
 	else:
 		raise TypeError('obj argument should be an image or a pixel value.')
 
 
+# 24 bit keys r + 256 * g + 256 ** 2 * b of the pixels of an image (or stack), as uint32
+def pack_colors(img):
+	keys = img[..., 2].astype(np.uint32)
+	keys <<= 8
+	keys |= img[..., 1]
+	keys <<= 8
+	keys |= img[..., 0]
+	return keys
+
+
 def num_hash(obj):
-	if is_rgb_image(obj):
-		return obj[:, :, 0] + 256 * obj[:, :, 1] + (256 ** 2) * obj[:, :, 2]
+	if is_rgb_image(obj) or is_rgb_batch(obj):
+		return pack_colors(obj)
 	elif is_pixel(obj):
 		return obj[0] + 256 * obj[1] + (256 ** 2) * obj[2]
 	else:
@@ -281,14 +319,37 @@ def num_hash_to_rgb(obj):
 
 
 def img_to_2d_num_hash(img):
-	check_img_arg(img)
+	check_img_arg(img, allow_batch=True)
 	return num_hash(img)
 
 
+# evaluates func on each distinct color of an image (or stack) only, then scatters the results back
+# returns an array of shape img.shape[:-1] + the shape of func's results
+def map_unique_colors(img, func):
+	check_img_arg(img, allow_batch=True)
+	_, first, inverse = np.unique(np.ravel(num_hash(img)), return_index=True, return_inverse=True)
+	vals = np.asarray([func(col) for col in img.reshape(-1, 3)[first]])
+	return vals[inverse].reshape(img.shape[:-1] + vals.shape[1:])
+
+
 # see https://stackoverflow.com/questions/596216/formula-to-determine-brightness-of-rgb-color
 def img_to_luminance(img):
-	check_img_arg(img)
-	return 0.2126 * img[:, :, 0] + 0.7152 * img[:, :, 1] + 0.0722 * img[:, :, 2]
+	check_img_arg(img, allow_batch=True)
+	return 0.2126 * img[..., 0] + 0.7152 * img[..., 1] + 0.0722 * img[..., 2]
+
+
+# HSV hue in [0, 1), 0 for grays
+# see https://en.wikipedia.org/wiki/HSL_and_HSV#Hue_and_chroma
+def img_to_hue(img):
+	check_img_arg(img, allow_batch=True)
+	rgb = img.astype(np.float32)
+	mx, mn = rgb.max(axis=-1), rgb.min(axis=-1)
+	chroma = mx - mn
+	safe = np.where(chroma > 0, chroma, 1)
+	r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+	hue = np.where(mx == r, (g - b) / safe, np.where(mx == g, 2 + (b - r) / safe, 4 + (r - g) / safe))
+	hue = np.where(chroma > 0, hue / 6 % 1, 0)
+	return hue.astype(np.float32)
 
 
 # path to imgproc base folder
@@ -0,0 +1,34 @@
+from imgproc.morph import blur, box_blur, modify_brightness, modify_contrast, modify_vividness, to_grayscale
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+import pytest
+
+
+# (H, W) images should match PIL's 'L' mode
+@pytest.fixture
+def gray():
+	return np.random.RandomState(0).randint(20, 230, size=(61, 83)).astype(np.uint8)
+
+
+@pytest.mark.parametrize('radius', [0.5, 2., 7.5, 40.])
+def test_blur(gray, radius):
+	expected = np.array(Image.fromarray(gray).filter(ImageFilter.GaussianBlur(radius)))
+	np.testing.assert_array_equal(blur(gray, radius), expected)
+	np.testing.assert_array_equal(box_blur(gray, radius), expected)
+
+
+@pytest.mark.parametrize('factor', [0., 0.6, 1.7])
+def test_enhance(gray, factor):
+	pil = Image.fromarray(gray)
+	np.testing.assert_array_equal(modify_brightness(gray, factor), np.array(ImageEnhance.Brightness(pil).enhance(factor)))
+	np.testing.assert_array_equal(modify_contrast(gray, factor), np.array(ImageEnhance.Contrast(pil).enhance(factor)))
+	np.testing.assert_array_equal(modify_vividness(gray, factor), np.array(ImageEnhance.Color(pil).enhance(factor)))
+
+
+def test_autocontrast(gray):
+	expected = np.array(ImageOps.autocontrast(Image.fromarray(gray)))
+	np.testing.assert_array_equal(modify_contrast(gray, 1., optimize=True), expected)
+
+
+def test_to_grayscale(gray):
+	np.testing.assert_array_equal(to_grayscale(gray), gray)